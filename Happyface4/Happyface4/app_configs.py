@@ -1,3 +1,5 @@
+import datetime
+import hashlib
 import logging
 from abc import ABCMeta, abstractmethod
 from asyncio.log import logger
@@ -5,9 +7,13 @@ from typing import Final, final
 
 from django.apps import AppConfig
 from django.conf import settings
+from django.core.cache import caches
 from django.template import loader
 from django.utils import timezone
 
+from . import helpers, metrics
+from .processes import prepare_in_process
+from .response_cache import get_response_cache
 from .status import STATUS
 
 # TODO: Make each instance one Analysis Config instance and not some list of dictionaries
@@ -78,6 +84,24 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
 
         pass
 
+    prepare_data_in_process: bool = False
+    """
+    If True, :func:`prepare_data` runs in a separate process of the process pool of
+    getData (with ``settings.PREPARE_PROCESSES`` processes), so CPU heavy parsing and
+    aggregation of several instances run in parallel instead of one after another in the
+    threads of getData.
+    """
+
+    skip_unchanged: bool = False
+    """
+    If True and ``settings.RESPONSE_CACHE_DIR`` is set, :func:`save_data_to_db` is skipped
+    if all responses the instance got in :func:`extract_data_from_url` are the same as
+    the last time, the status it returned then is saved for the current time. This
+    requires that all data is fetched with the helpers of :mod:`Happyface4.helpers`
+    (except the streaming ones) and that :func:`retrieve_data_from_db` also finds data
+    which was saved more than one pull interval ago.
+    """
+
     def __init__(self, app_name, app_module):
         # calls the __init__ function of the parent class AppConfig
         super().__init__(app_name, app_module)
@@ -126,7 +150,7 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
                 inst["get_data_every"] = 1
 
     @final
-    def getData(self, instance):
+    def getData(self, instance, status_writer=None):
         """
         Central function which is called by the global getData command for each instance.
         Handles the process of fetching and saving data and calculating the instance status.
@@ -137,29 +161,84 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
                 :class:`getData <~commands.management.commands.getData.command>` function.
         :type instance: dict
 
-        """
+        :param status_writer: Collects the instance status to save it together with the
+                              statuses of the other instances. If it is None, the status
+                              is saved directly.
+        :type status_writer: ~Happyface4.fetcher.StatusWriter
 
-        from .models import InstanceStatus
+        """
 
-        data = self.extract_data_from_url(instance)
+        from .models import HighWaterMark, InstanceStatus
 
-        # checks whether data was fetched and if not sets the status for the actual time
-        if data:
-            status, time = self.save_data_to_db(data, instance)
-        else:
-            status = STATUS.TECHNICAL_ISSUE
-            time = timezone.now()
-            self.logger.error(f"Instance {instance['name']}: Couldn't fetch data.")
-        # Don't save the status if the save_data_to_db method doesn't return a status
-        if status is not None:
-            # saves the alert level
-            InstanceStatus.objects.update_or_create(
-                time=time,
-                instance=instance["name"],
-                category=instance["category"],
-                status=status,
+        incremental = self.is_incremental()
+        if incremental:
+            # the analysis gets a copy of the instance with the time of the newest data
+            # it saved, so it only needs to request newer data
+            instance = dict(
+                instance, since=HighWaterMark.objects.get_time(instance["name"])
             )
 
+        with metrics.measure("getData", self.name, instance["name"]) as measurement:
+            # the responses are recorded to check whether they changed since the last
+            # time
+            response_cache = get_response_cache() if self.skip_unchanged else None
+            with metrics.measure(
+                "extract", self.name, instance["name"]
+            ) as extract, helpers.record_responses() as response_hashes:
+                data = self.extract_data_from_url(instance)
+                extract.error = not data
+
+            fingerprint = None
+            if (
+                response_cache is not None
+                and response_hashes
+                and None not in response_hashes
+            ):
+                fingerprint = hashlib.sha256(
+                    "".join(response_hashes).encode()
+                ).hexdigest()
+            previous = fingerprint and response_cache.get_instance(instance["name"])
+
+            # checks whether data was fetched and if not sets the status for the actual
+            # time
+            if data and previous and previous["fingerprint"] == fingerprint:
+                # the data didn't change, so it isn't saved again
+                self.logger.debug(
+                    f"Instance {instance['name']}: The data didn't change, it isn't saved."
+                )
+                status, time = previous["status"], timezone.now()
+            elif data:
+                if self.prepare_data_in_process:
+                    with metrics.measure("prepare", self.name, instance["name"]):
+                        data = prepare_in_process(self.label, data, instance)
+                else:
+                    data = self.prepare_data(data, instance)
+                with metrics.measure("save", self.name, instance["name"]):
+                    status, time = self.save_data_to_db(data, instance)
+                # the data was saved successfully, so the next fetch can start after it
+                high_water_mark = (
+                    self.get_high_water_mark(data, instance) if incremental else None
+                )
+                if high_water_mark is not None:
+                    HighWaterMark.objects.advance(instance["name"], high_water_mark)
+                if fingerprint:
+                    response_cache.put_instance(instance["name"], fingerprint, status)
+            else:
+                status = STATUS.TECHNICAL_ISSUE
+                time = timezone.now()
+                self.logger.error(f"Instance {instance['name']}: Couldn't fetch data.")
+                measurement.error = True
+            # Don't save the status if the save_data_to_db method doesn't return a status
+            if status is not None:
+                # saves the alert level
+                with metrics.measure("status_write", self.name, instance["name"]):
+                    (status_writer or InstanceStatus.objects).update_or_create(
+                        time=time,
+                        instance=instance["name"],
+                        category=instance["category"],
+                        status=status,
+                    )
+
     @abstractmethod
     def extract_data_from_url(self, instance):
         """This function uses source given in the instance to fetch the data from the
@@ -168,6 +247,11 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
 
         :param instance: The dict with the properties of a analysis instance, this is
                          overgiven automatically by the :func:`getData` function.
+                         If the analysis implements :func:`get_high_water_mark`, it
+                         contains the time of the newest saved data point as ``since``
+                         (``None`` before the first data was saved), e.g. to add it to
+                         the query with :func:`~Happyface4.helpers.es_query_since` or
+                         :func:`~Happyface4.helpers.influxql_since`.
         :type instance: dict
 
         :return: The data fetched from the url.
@@ -184,6 +268,26 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
         dictionary = {}
         return dictionary
 
+    def prepare_data(self, data, instance):
+        """This function can be overwritten to parse and aggregate the fetched data before
+        it is given to :func:`save_data_to_db`, e.g. to calculate the rows of the database
+        tables. It returns the data unchanged by default.
+        If :attr:`prepare_data_in_process` is set, it runs in another process, so it must
+        not use the database and the data it gets and returns is pickled, e.g. lists of
+        dicts or tuples of plain values.
+
+        :param data: This is exactly the data which is returned from the
+                     :func:`extract_data_from_url` function.
+        :type data: dict or list
+        :param instance: The dict with the properties of a analysis instance, this is
+                         overgiven automatically by the :func:`getData` function.
+        :type instance: dict
+        :return: The data which is given to :func:`save_data_to_db`.
+
+        """
+
+        return data
+
     @abstractmethod
     def save_data_to_db(self, data, instance):
         """This function takes the fetched data and preperes it for the database and
@@ -241,11 +345,52 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
 
         return instance_status, time
 
+    def get_high_water_mark(self, data, instance):
+        """This function can be overwritten to fetch only new data. It returns the time of
+        the newest data point in the data, which was saved by :func:`save_data_to_db`.
+        The time is saved and the next time :func:`extract_data_from_url` gets it as
+        ``instance["since"]``, so it can request only data which is newer. If data can
+        arrive late at the source, the analysis can request some time before ``since``.
+        By default no time is saved.
+
+        :param data: The data given to :func:`save_data_to_db`.
+        :type data: dict or list
+        :param instance: The dict with the properties of a analysis instance.
+        :type instance: dict
+        :return: The time of the newest data point or ``None``, e.g. if there was no new
+                 data.
+        :rtype: ~datetime.datetime
+
+        """
+
+        return None
+
+    def delete_data_before(self, time):
+        """This function deletes the data of the analysis which is older than the given
+        time. It is called by the ``compactStatuses`` command if
+        ``settings.DATA_RETENTION`` is set and does nothing by default, so it needs to be
+        overwritten to limit the size of the database tables of the analysis, e.g.:
+
+        .. code-block:: python
+
+           from . import models
+           models.ExampleModel.objects.filter(time__lt=time).delete()
+
+        :param time: The time before which the data can be deleted.
+        :type time: ~datetime.datetime
+
+        """
+
+        pass
+
     @final
-    def builddiv(self, time_of_readout, instance, request):
+    def builddiv(self, time_of_readout, instance, request, historical=False):
         """Central function which is called if there is a http request to a category with
         this instance in it. Calls the retrieve_data_from_db function and renders the
         template with the data optained from the database.
+        The rendered div is cached (``settings.CACHES["divs"]``) for the timestamp of the
+        data retrieve_data_from_db returns, the status and the age of the data, so it is
+        rendered again as soon as newer data or a newer status is found.
 
         :meta private:
         :param time_of_readout: The time the data is requested for.
@@ -258,12 +403,53 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
                         answer the request.
         :type request: ~django.http.HttpRequest
 
+        :param historical: Whether the time was explicitly requested. Divs of a past time
+                           are cached without timeout.
+        :type historical: bool
+
         :returns: The rendered Template which contains the complete and ready HTML code for
                   this analysis.
         :rtype: django Template object
 
         """
 
+        with metrics.measure("builddiv", self.name, instance["name"]) as measurement:
+            data, timestamp, history_steps, status = self._retrieve_div_data(
+                time_of_readout, instance
+            )
+            cache_key = "div:{}:{}:{}:{}:{}:{}".format(
+                self.name,
+                instance["name"],
+                instance["template"],
+                (
+                    timestamp.isoformat()
+                    if isinstance(timestamp, datetime.datetime)
+                    else timestamp
+                ),
+                history_steps,
+                status,
+            )
+            div_cache = caches["divs"]
+            div = div_cache.get(cache_key)
+            if div is None:
+                div = self._render_div(
+                    instance, request, data, timestamp, history_steps, status
+                )
+                # the data of a past time doesn't change anymore after it was fetched
+                if historical and time_of_readout < timezone.now() - instance["dt"] * (
+                    instance.get("get_data_every", 1) + 1
+                ):
+                    div_cache.set(cache_key, div, timeout=None)
+                else:
+                    div_cache.set(cache_key, div)
+            measurement.add_payload(len(div))
+            return div
+
+    def _retrieve_div_data(self, time_of_readout, instance):
+        """Returns the data of the instance and its timestamp, the number of pull
+        intervals the data is older than time_of_readout and the status shown in the div,
+        see :func:`builddiv`."""
+
         # loads the global setting of the timedelta after which new data is fetched. So we
         # only need to search for data in the frame time_of_readout-dt to time_of_readout.
         dt = instance["dt"]
@@ -298,9 +484,16 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
                 time_of_readout -= dt
                 history_steps += 1
 
+        if not data:
+            status = STATUS.TECHNICAL_ISSUE
+        return data, timestamp, history_steps, status
+
+    def _render_div(self, instance, request, data, timestamp, history_steps, status):
+        """Renders the template of the instance, see :func:`builddiv`."""
+        dt = instance["dt"]
         # the context dict which is overgiven to the template
         context = {
-            "status": status if data else STATUS.TECHNICAL_ISSUE,
+            "status": status,
             "old_data_warning": (
                 {
                     "hours": (history_steps * dt).seconds // 3600,
@@ -388,12 +581,47 @@ class AnalysisConfig(AppConfig, metaclass=ABCMeta):
         """
         from .models import InstanceStatus
 
-        if not time_range or time_range <= settings.PULL_INTERVAL:
-            time_range = settings.PULL_INTERVAL * instance.get("get_data_every", 1)
-
         return InstanceStatus.objects.get_instance_status(
             time=time,
             instance_name=instance["name"],
             category=instance["category"],
-            time_range=time_range,
+            time_range=self.get_status_time_range(instance, time_range),
         )
+
+    @final
+    def get_status_time_range(self, instance, time_range=None):
+        """Returns the time range in which the statuses of a instance are searched. It is
+        at least the interval in which the data of the instance is fetched.
+
+        :meta private:
+        :param instance: The dict with the properties of a analysis instance.
+        :type instance: dict
+
+        :param time_range: The requested time range.
+        :type time_range: ~datetime.timedelta
+
+        :rtype: ~datetime.timedelta
+        """
+        if not time_range or time_range <= settings.PULL_INTERVAL:
+            time_range = settings.PULL_INTERVAL * instance.get("get_data_every", 1)
+        return time_range
+
+    @final
+    def is_incremental(self):
+        """Whether the analysis implements :func:`get_high_water_mark`, so its instances
+        get the time of their newest saved data point.
+
+        :meta private:
+        :rtype: bool
+        """
+        return type(self).get_high_water_mark is not AnalysisConfig.get_high_water_mark
+
+    @final
+    def has_default_instance_status(self):
+        """Whether the analysis uses the default :func:`get_instance_status`. The statuses
+        of such analyses can be loaded in bulk together with the other instances.
+
+        :meta private:
+        :rtype: bool
+        """
+        return type(self).get_instance_status is AnalysisConfig.get_instance_status
@@ -0,0 +1,511 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+
+from . import helpers, metrics, processes
+
+logger = logging.getLogger("getData")
+
+
+class Fetcher(object):
+    """
+    Fetches the data of analysis instances concurrently. Each instance is an asyncio task
+    which runs the blocking :func:`~Happyface4.app_configs.AnalysisConfig.getData` in a
+    thread, so a slow source only delays its own instance.
+
+    :param concurrency: Maximum number of instances fetched at the same time.
+    :type concurrency: int
+    :param host_concurrency: Maximum number of instances fetched at the same time from
+                             the same host.
+    :type host_concurrency: int
+    :param timeout: Seconds after which the fetch of an instance is given up. Can be set
+                    per instance with the ``timeout`` key.
+    :type timeout: float
+
+    Used as context manager, the fetcher keeps its threads (with their HTTP and database
+    connections) between the runs, e.g. in the getDataRoutine command:
+
+    .. code-block:: python
+
+        with Fetcher() as fetcher:
+            fetcher.serve(scheduler, stop)
+    """
+
+    def __init__(self, concurrency=None, host_concurrency=None, timeout=None):
+        self.concurrency = concurrency or settings.FETCH_CONCURRENCY
+        self.host_concurrency = host_concurrency or settings.FETCH_HOST_CONCURRENCY
+        self.timeout = timeout or settings.FETCH_TIMEOUT
+        self.last_cycle = None
+        """Timing of the last run, see :func:`run`."""
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ThreadPool(self.concurrency, thread_name_prefix="fetcher")
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+        self._executor = None
+        processes.shutdown()
+
+    def run(self, instances):
+        """
+        Fetches the data of the instances and returns when all instances are done or
+        timed out. Afterwards :attr:`last_cycle` is a dict with the number of
+        ``instances``, how many of them ``succeeded``, the ``fetch_seconds`` and
+        ``write_seconds`` the run took and the timestamp when it ``finished``.
+
+        :param instances: ``(analysis, instance)`` tuples.
+        :type instances: list of tuple
+        :returns: The number of instances whose data was fetched successfully.
+        :rtype: int
+        """
+        if not instances:
+            return 0
+        self._prepare()
+        try:
+            return asyncio.run(
+                self._run_cycle(
+                    [(analysis, instance, None) for analysis, instance in instances],
+                    *self._limits(),
+                )
+            )
+        finally:
+            # the processes are only kept by a fetcher used as context manager
+            if self._executor is None:
+                processes.shutdown()
+            # the metrics of a single run would be lost otherwise
+            metrics.flush(force=True)
+
+    def serve(self, scheduler, stop):
+        """
+        Runs the jobs of the scheduler until ``stop`` is set. The instances of the fetch
+        jobs which are due at the same time are fetched together like in :func:`run`,
+        other jobs run their function in a thread. The statuses of all cycles are
+        collected and saved together every ``settings.STATUS_FLUSH_INTERVAL`` seconds.
+        The fetcher has to be used as context manager.
+
+        :param scheduler: The scheduler with the jobs.
+        :type scheduler: ~Happyface4.scheduler.Scheduler
+        :param stop: Stops the fetcher when it is set, running jobs are finished.
+        :type stop: threading.Event
+        """
+        self._prepare()
+        try:
+            asyncio.run(self._serve(scheduler, stop))
+        finally:
+            metrics.flush(force=True)
+
+    def _prepare(self):
+        from .models import Category, Instance
+
+        if self._executor is not None:
+            # the connection of this thread is reused, it may have been lost meanwhile
+            close_unusable_connections()
+        # the ids of the instance and category names are loaded once per process
+        Instance.objects.get_ids([])
+        Category.objects.get_ids([])
+
+    def _limits(self):
+        # the semaphores which limit the concurrent fetches in total and per host
+        return asyncio.Semaphore(self.concurrency), defaultdict(
+            lambda: asyncio.Semaphore(self.host_concurrency)
+        )
+
+    async def _serve(self, scheduler, stop):
+        concurrency, host_concurrency = self._limits()
+        # usually only few instances are due at the same time, so the statuses of the
+        # cycles are saved together
+        status_writer = StatusWriter()
+        last_flush = time.monotonic()
+        tasks = set()
+        while not stop.is_set():
+            jobs = scheduler.pop_due(time.time())
+            fetch_jobs = [
+                (job.analysis, job.instance, job)
+                for job in jobs
+                if job.function is None
+            ]
+            if fetch_jobs:
+                tasks.add(
+                    asyncio.create_task(
+                        self._run_cycle(
+                            fetch_jobs, concurrency, host_concurrency, status_writer
+                        )
+                    )
+                )
+            for job in jobs:
+                if job.function is not None:
+                    tasks.add(asyncio.create_task(self._run_job(job)))
+            tasks = {task for task in tasks if not task.done()}
+            if time.monotonic() - last_flush >= settings.STATUS_FLUSH_INTERVAL:
+                await asyncio.to_thread(flush_in_thread, status_writer, True, False)
+                last_flush = time.monotonic()
+            # sleep until the next job is due or the statuses are saved
+            timeout = last_flush + settings.STATUS_FLUSH_INTERVAL - time.monotonic()
+            next_time = scheduler.next_time()
+            if next_time is not None:
+                timeout = min(timeout, next_time - time.time())
+            await asyncio.to_thread(stop.wait, max(timeout, 0))
+        await asyncio.gather(*tasks)
+        await asyncio.to_thread(flush_in_thread, status_writer, True)
+
+    async def _run_job(self, job):
+        try:
+            await asyncio.to_thread(job.function)
+        except Exception:
+            logger.exception(f"{job.name} failed.")
+        finally:
+            job.running = False
+
+    async def _run_cycle(
+        self, instances, concurrency, host_concurrency, status_writer=None
+    ):
+        # without a kept thread pool, one thread per instance, the semaphores limit how
+        # many of them fetch at once. Threads of timed out instances can't be stopped
+        # and keep running, the kept pool starts new threads for the other instances
+        # instead of waiting for them.
+        # the statuses are saved at the end of the cycle, unless the caller passes its
+        # own status writer
+        executor = self._executor or ThreadPoolExecutor(max_workers=len(instances))
+        flush = status_writer is None
+        if flush:
+            status_writer = StatusWriter()
+        start = time.monotonic()
+        succeeded = 0
+        # identical requests of the instances of the cycle are sent once, the tasks of
+        # the instances get the cycle with the copy of the context
+        cycle = helpers.fetch_cycle() if settings.FETCH_COALESCE else nullcontext()
+        try:
+            with cycle:
+                results = await asyncio.gather(
+                    *[
+                        self._fetch(
+                            executor,
+                            concurrency,
+                            host_concurrency[source_host(instance)],
+                            analysis,
+                            instance,
+                            status_writer,
+                            job,
+                        )
+                        for analysis, instance, job in instances
+                    ]
+                )
+            succeeded = sum(results)
+        finally:
+            if executor is not self._executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+            fetched = time.monotonic()
+            if flush:
+                # database queries aren't allowed in the event loop
+                await asyncio.to_thread(
+                    flush_in_thread, status_writer, self._executor is not None
+                )
+            self.last_cycle = {
+                "instances": len(instances),
+                "succeeded": succeeded,
+                "fetch_seconds": fetched - start,
+                "write_seconds": time.monotonic() - fetched,
+                "finished": time.time(),
+            }
+            logger.info(
+                f"Fetched {succeeded} of {len(instances)} instances in {fetched - start:.1f} s"
+                + (
+                    f", saved the statuses in {self.last_cycle['write_seconds']:.2f} s."
+                    if flush
+                    else "."
+                )
+            )
+        return succeeded
+
+    async def _fetch(
+        self,
+        executor,
+        concurrency,
+        host_concurrency,
+        analysis,
+        instance,
+        status_writer,
+        job=None,
+    ):
+        # the host limit is acquired first, so instances waiting for a busy host don't
+        # block the global limit
+        async with host_concurrency, concurrency:
+            timeout = instance.get("timeout", self.timeout)
+            # the thread runs in a copy of the context, e.g. with the fetch cycle
+            future = executor.submit(
+                contextvars.copy_context().run,
+                get_data,
+                analysis,
+                instance,
+                status_writer,
+                executor is self._executor,
+            )
+            if job is not None:
+                # the job is running until its thread is done, even if it timed out
+                future.add_done_callback(lambda _: setattr(job, "running", False))
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                logger.error(
+                    f"Timeout: fetching data for module: {analysis.name}, instance: {instance['name']} took more than {timeout} s."
+                )
+                return False
+
+
+class ThreadPool(object):
+    """
+    Runs functions in threads, which are kept for the next functions. Unlike a
+    :class:`~concurrent.futures.ThreadPoolExecutor` the number of busy threads isn't
+    limited: if all threads are busy, e.g. with fetches which timed out and can't be
+    stopped, a new thread is started, so a function never waits in a queue and its
+    timeout starts when it is submitted. The callers limit how many functions run.
+
+    :param max_idle: Maximum number of idle threads, which are kept.
+    :type max_idle: int
+    :param thread_name_prefix: Prefix of the names of the threads.
+    :type thread_name_prefix: str
+    """
+
+    def __init__(self, max_idle, thread_name_prefix="ThreadPool"):
+        self.max_idle = max_idle
+        self.thread_name_prefix = thread_name_prefix
+        # the work queues of the idle threads
+        self._idle = []
+        self._started = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Runs ``function(*args)`` in an idle or a new thread.
+
+        :returns: The future of the result.
+        :rtype: ~concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            if self._idle:
+                work = self._idle.pop()
+            else:
+                work = queue.SimpleQueue()
+                self._started += 1
+                # daemon threads, so a hanging fetch doesn't block the exit
+                threading.Thread(
+                    target=self._work,
+                    args=(work,),
+                    name=f"{self.thread_name_prefix}_{self._started}",
+                    daemon=True,
+                ).start()
+        work.put((future, function, args))
+        return future
+
+    def shutdown(self):
+        """Stops the idle threads, busy threads stop when their function is done."""
+        with self._lock:
+            self._shutdown = True
+            idle, self._idle = self._idle, []
+        for work in idle:
+            work.put(None)
+
+    def _work(self, work):
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                future, function, args = item
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+                del item, future, function, args
+                with self._lock:
+                    if self._shutdown or len(self._idle) >= self.max_idle:
+                        return
+                    self._idle.append(work)
+        finally:
+            connections.close_all()
+
+
+class StatusWriter(object):
+    """
+    Collects the instance statuses of one or more fetch cycles, which are saved together
+    with :func:`flush`.
+    """
+
+    def __init__(self):
+        self._statuses = []
+        self._flushed = False
+        self._lock = threading.Lock()
+
+    def update_or_create(self, time, instance, category, status):
+        with self._lock:
+            if not self._flushed:
+                self._statuses.append((time, instance, category, status))
+                return
+        # the writer is already closed, e.g. because the instance timed out
+        from .models import InstanceStatus
+
+        InstanceStatus.objects.update_or_create(time, instance, category, status)
+
+    def flush(self, final=True):
+        """
+        Saves the collected statuses with one query. If that fails, e.g. because an
+        analysis returned an invalid status or time, the statuses are saved one by one,
+        so only the invalid ones are lost.
+
+        :param final: Whether the writer is closed, later statuses are saved directly.
+                      Otherwise it keeps collecting them for the next flush.
+        :type final: bool
+        """
+        from .models import InstanceStatus
+
+        with self._lock:
+            statuses, self._statuses = self._statuses, []
+            self._flushed = self._flushed or final
+        if not statuses:
+            return
+        with metrics.measure("status_flush", "", ""):
+            try:
+                InstanceStatus.objects.bulk_update_or_create(statuses)
+                return
+            except Exception:
+                logger.exception(
+                    "Saving the statuses with one query failed, saving them one by one."
+                )
+            for status_time, instance, category, status in statuses:
+                try:
+                    InstanceStatus.objects.update_or_create(
+                        status_time, instance, category, status
+                    )
+                except Exception:
+                    logger.exception(
+                        f"Saving the status {status} at {status_time} of {instance} ({category}) failed."
+                    )
+
+
+def flush_in_thread(status_writer, keep_connections=False, final=True):
+    """
+    Saves the statuses of the writer in a thread of the event loop.
+
+    :param keep_connections: Whether the thread is reused and keeps its database
+                             connections.
+    :type keep_connections: bool
+    :param final: Whether the writer is closed, see :func:`StatusWriter.flush`.
+    :type final: bool
+    """
+    try:
+        status_writer.flush(final)
+    finally:
+        if keep_connections:
+            close_unusable_connections()
+        else:
+            connections.close_all()
+
+
+def get_data(analysis, instance, status_writer=None, keep_connections=False):
+    """
+    Calls getData of the analysis for the instance and logs errors.
+
+    :param keep_connections: Whether the thread is reused and keeps its database
+                             connections.
+    :type keep_connections: bool
+
+    :returns: Whether the data was fetched successfully.
+    :rtype: bool
+    """
+    logger.debug(
+        f"Start get data for module: {analysis.name}, instance: {instance['name']}"
+    )
+    try:
+        analysis.getData(instance, status_writer)
+        logger.info(
+            f"Fetched data for module: {analysis.name}, instance: {instance['name']}"
+        )
+        return True
+
+    except Exception:
+        logger.error(
+            f"""
+#################################################
+An Error has occurred in the getData function.
+Analysis:       {analysis.name}
+Instance:       {instance["name"]}
+Verbose name:   {instance["verbose_name"]}
+Error:
+{traceback.format_exc(limit=10)}
+"""
+        )
+        return False
+    finally:
+        # the thread opened its own database connections
+        if keep_connections:
+            close_unusable_connections()
+        else:
+            connections.close_all()
+
+
+def close_unusable_connections():
+    """
+    Closes the database connections of the thread which had errors and aren't usable
+    anymore, so they are opened again on the next query. Unlike
+    :func:`django.db.close_old_connections` it keeps the connections regardless of
+    ``CONN_MAX_AGE``.
+    """
+    for connection in connections.all(initialized_only=True):
+        if connection.errors_occurred and not connection.is_usable():
+            connection.close()
+        connection.errors_occurred = False
+
+
+def due_instances(analyses, time):
+    """
+    Returns the instances of the analyses for which it is time to get data at the given
+    time (based on the pull interval and the get_data_every parameter of the instance).
+
+    :param analyses: The analyses.
+    :type analyses: list of AnalysisConfig
+    :param time: The time, usually the start of a pull interval.
+    :type time: ~datetime.datetime
+    :returns: ``(analysis, instance)`` tuples.
+    :rtype: list of tuple
+    """
+    minutes = time.hour * 60 + time.minute
+    pull_intervall_minutes = settings.PULL_INTERVAL.seconds // 60
+    due = []
+    for analysis in analyses:
+        for instance in analysis.instances:
+            get_data_every = instance.get("get_data_every", 1)
+            # skip if it is not time to get data for this instance
+            if (
+                minutes % (pull_intervall_minutes * get_data_every)
+                >= pull_intervall_minutes
+            ):
+                logger.debug(f"SKIP: {instance['name']} (of module: {analysis.name})")
+                continue
+            due.append((analysis, instance))
+    return due
+
+
+def source_host(instance):
+    """Returns the host of the (first) source of the instance."""
+    source = instance["source"]
+    if type(source) == list:
+        source = source[0] if source else ""
+    return urlsplit(source).hostname or source
@@ -1,7 +1,331 @@
+import contextvars
+import copy
+import hashlib
 import json
+import logging
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
 import requests
 import pycurl
+import ijson
 from io import BytesIO
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from . import metrics
+from .response_cache import get_response_cache
+
+# HTTP status codes after which a request is retried
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_curl_share = None
+_curl_handles = threading.local()
+# the running fetch cycle, see fetch_cycle
+_fetch_cycle = contextvars.ContextVar("fetch_cycle", default=None)
+# the content hashes of the responses, see record_responses
+_recorded_responses = contextvars.ContextVar("recorded_responses", default=None)
+
+
+def get_session():
+    """Returns the :class:`requests.Session` shared by all threads. Its connections are
+    kept alive and reused between requests to the same host, failed requests are retried
+    with exponential backoff.
+
+    The pool size, the number of retries and the backoff factor are set with
+    ``settings.HTTP_POOL_SIZE``, ``settings.HTTP_RETRIES`` and ``settings.HTTP_BACKOFF``.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = getattr(settings, "HTTP_POOL_SIZE", 10)
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=Retry(
+                    total=getattr(settings, "HTTP_RETRIES", 3),
+                    backoff_factor=getattr(settings, "HTTP_BACKOFF", 0.5),
+                    status_forcelist=RETRY_STATUS_CODES,
+                    raise_on_status=False,
+                ),
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def get_timeout():
+    """Returns the (connect, read) timeout in seconds for HTTP requests."""
+    return (
+        getattr(settings, "HTTP_CONNECT_TIMEOUT", 10),
+        getattr(settings, "HTTP_READ_TIMEOUT", 120),
+    )
+
+
+class FetchCycle(object):
+    """
+    The requests of a fetch cycle of getData. Identical requests (method, url, headers
+    and body) of several instances, which are sent at the same time while the cycle
+    runs, are sent only once and all instances get the same response. Each instance
+    parses the response itself, so they can't change the data of the others. A response
+    is only kept while its request is in flight, afterwards it belongs to the waiting
+    instances and the request is sent again if it is asked for again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key, send):
+        """Returns the result of ``send()`` for the request ``key``, which is only called
+        by the first thread asking for the key, the others asking while it runs wait for
+        its result."""
+        with self._lock:
+            flight = self._flights.get(key)
+            first = flight is None
+            if first:
+                flight = self._flights[key] = _Flight()
+        if first:
+            try:
+                flight.result = send()
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                # the waiting threads keep the flight, so the response isn't kept longer
+                # than they need it
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+        return flight.result
+
+
+class _Flight(object):
+    # a request of a fetch cycle, which was sent by one thread and is awaited by others
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+@contextmanager
+def fetch_cycle():
+    """
+    Identical requests of the helpers (:func:`fetch`,
+    :func:`get_data_from_elasticsearch` and :func:`get_data_from_grafana`) in the block
+    and in threads started with a copy of its context are sent once (see
+    :class:`FetchCycle`). Used by the fetcher for each cycle, if
+    ``settings.FETCH_COALESCE`` is set.
+    """
+    token = _fetch_cycle.set(FetchCycle())
+    try:
+        yield
+    finally:
+        _fetch_cycle.reset(token)
+
+
+def _coalesce(key, send):
+    # sends the request once per fetch cycle if a cycle is running
+    cycle = _fetch_cycle.get()
+    if cycle is None:
+        return send()
+    return cycle.fetch(key, send)
+
+
+class SharedResponse(object):
+    """
+    The response of :func:`fetch`, which can be shared by several instances.
+
+    :param status_code: The HTTP status code.
+    :type status_code: int
+    :param headers: The response headers.
+    :type headers: ~requests.structures.CaseInsensitiveDict
+    :param content: The response body.
+    :type content: bytes
+    :param content_hash: The sha256 hash of the body.
+    :type content_hash: str
+    """
+
+    def __init__(self, status_code, headers, content, content_hash):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.content_hash = content_hash
+
+    @property
+    def text(self):
+        return self.content.decode("utf8", errors="replace")
+
+    def json(self):
+        """Parses the body, each call returns a new object."""
+        return json.loads(self.content)
+
+
+def fetch(method, url, headers=None, params=None, data=None, json_body=None):
+    """
+    Sends a request with the shared session (see :func:`get_session`). Identical
+    requests of the instances in the same fetch cycle of getData, which are sent at the
+    same time, are only sent once, so this should be used by ``extract_data_from_url``
+    if several instances use the same source.
+
+    .. code-block:: python
+
+        r = helpers.fetch("GET", instance["source"])
+        data = r.json()
+
+    :param method: The HTTP method, e.g. ``"GET"``.
+    :type method: str
+    :param url: The url.
+    :type url: str
+    :param headers: The HTTP headers.
+    :type headers: dict
+    :param params: The query parameters.
+    :type params: dict
+    :param data: The body.
+    :type data: str or bytes
+    :param json_body: The body as JSON like dict or list, instead of ``data``.
+    :rtype: SharedResponse
+    """
+    if json_body is not None:
+        data = json.dumps(json_body)
+        headers = {"Content-Type": "application/json", **(headers or {})}
+    key = (
+        method.upper(),
+        url,
+        tuple(sorted((headers or {}).items())),
+        tuple(sorted((params or {}).items())),
+        data,
+    )
+
+    def send(conditional_headers):
+        r = get_session().request(
+            method,
+            url,
+            headers={**(headers or {}), **conditional_headers},
+            params=params,
+            data=data,
+            timeout=get_timeout(),
+        )
+        metrics.add_payload(len(r.content))
+        return r.status_code, r.headers, r.content
+
+    response = _coalesce(key, lambda: _send_cached(key, send))
+    _record(response.content_hash)
+    return response
+
+
+@contextmanager
+def record_responses():
+    """
+    Collects the content hashes of the responses the helpers got in the block, e.g. to
+    check whether the data of an instance changed. Responses of the streaming helpers
+    (:func:`iter_data_from_elasticsearch` and :func:`scroll_elasticsearch`) are recorded
+    as ``None``, because they aren't hashed.
+
+    :returns: The list to which the hashes are added.
+    :rtype: list of str
+    """
+    hashes = []
+    token = _recorded_responses.set(hashes)
+    try:
+        yield hashes
+    finally:
+        _recorded_responses.reset(token)
+
+
+def _record(content_hash):
+    hashes = _recorded_responses.get()
+    if hashes is not None:
+        hashes.append(content_hash)
+
+
+def _send_cached(key, send):
+    # sends the request with send(conditional_headers), which returns the status code,
+    # headers and body. If the response is in the response cache, it is only sent again
+    # by the source if it changed (status 304 otherwise).
+    cache = get_response_cache()
+    cached = cache.get(key) if cache is not None else None
+    conditional_headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            conditional_headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            conditional_headers["If-Modified-Since"] = cached["last_modified"]
+    status_code, headers, body = send(conditional_headers)
+    if status_code == 304 and cached is not None:
+        body = cache.read(key, cached["content_hash"])
+        if body is not None:
+            return SharedResponse(
+                200,
+                CaseInsensitiveDict(cached["headers"]),
+                body,
+                cached["content_hash"],
+            )
+        # the response was deleted or replaced in the cache meanwhile
+        status_code, headers, body = send({})
+    content_hash = hashlib.sha256(body).hexdigest()
+    if (
+        cache is not None
+        and status_code == 200
+        and (
+            cached is None
+            or cached["content_hash"] != content_hash
+            or cached["etag"] != headers.get("ETag")
+            or cached["last_modified"] != headers.get("Last-Modified")
+        )
+    ):
+        cache.put(key, headers, body, content_hash)
+    return SharedResponse(status_code, headers, body, content_hash)
+
+
+def get_curl():
+    """Returns the pycurl handle of the current thread. Curl handles can't be used by
+    several threads at once, so each thread reuses its own handle, which keeps its
+    connections alive. The DNS cache and TLS sessions are shared between the handles of
+    all threads."""
+    global _curl_share
+    curl = getattr(_curl_handles, "curl", None)
+    if curl is None:
+        with _session_lock:
+            if _curl_share is None:
+                _curl_share = pycurl.CurlShare()
+                _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+                # the connection cache isn't shared, libcurl doesn't support using
+                # it from concurrent threads
+                _curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, _curl_share)
+        _curl_handles.curl = curl
+    else:
+        # only the options are reset, the connections and the share stay
+        curl.reset()
+    connect_timeout, read_timeout = get_timeout()
+    curl.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+    # abort if no data was received for read_timeout seconds
+    curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+    curl.setopt(pycurl.LOW_SPEED_TIME, read_timeout)
+    return curl
+
+
+def header_dict(header):
+    """Converts pycurl style headers like ``["Content-Type: application/json"]`` into a
+    dict for requests."""
+    return {
+        key.strip(): value.strip()
+        for key, value in (line.split(":", 1) for line in header)
+    }
 
 
 def get_data_from_elasticsearch(base_url, header, query_head, query_body, logger):
@@ -10,33 +334,84 @@ def get_data_from_elasticsearch(base_url, header, query_head, query_body, logger
     # important: There has to be a newline between header and body
     # see here for more information: https://www.elastic.co/guide/en/elasticsearch/reference/master/search-multi-search.html
     request = "\n" + json.dumps(query_head) + "\n" + json.dumps(query_body) + "\n"
-    logger.debug(f"using query:\n{request}")
+    return _msearch(base_url, header, request, logger)
+
+
+def get_data_from_elasticsearch_batch(base_url, header, queries, logger):
+    """Batch variant of :func:`get_data_from_elasticsearch`, which sends several queries
+    with one multi search request and splits the responses per query.
+
+    If the instances of an analysis need different queries of the same source, each
+    instance can send the queries of all instances and take its own result. The batch
+    is only sent once if the instances are fetched in the same cycle (see
+    :func:`fetch_cycle`). getDataRoutine does this only with ``FETCH_COALESCE`` for
+    instances with the same ``source``, otherwise each instance sends the whole batch.
+
+    Args:
+        base_url (str): Url of the ``_msearch`` endpoint.
+        header (list of str): HTTP headers like ``"Authorization: Bearer ..."``.
+        queries (list of tuple): ``(query_head, query_body)`` tuples.
+        logger (logging.Logger): The logger of the analysis.
+
+    Returns:
+        list of dict: The result of each query, like the result of
+                      :func:`get_data_from_elasticsearch` with only this query.
+    """
+    logger.debug(f"Starting data extraction of {len(queries)} queries from elastic API")
+    request = "\n" + "".join(
+        json.dumps(query_head) + "\n" + json.dumps(query_body) + "\n"
+        for query_head, query_body in queries
+    )
+    result = _msearch(base_url, header, request, logger)
+    responses = result.get("responses", [])
+    if len(responses) != len(queries):
+        raise Exception(
+            f"Got {len(responses)} responses for {len(queries)} queries from {base_url}."
+        )
+    return [
+        dict(
+            {key: value for key, value in result.items() if key != "responses"},
+            responses=[response],
+        )
+        for response in responses
+    ]
+
+
+def _msearch(base_url, header, request, logger):
+    # sends the multi search request and returns the parsed response
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"using query:\n{request}")
     # get the data with pycurl (http://pycurl.io/docs/latest/quickstart.html)
     # pycurl needs a function to write the http response to, we use BytesIO
     # the correspondig curl command is: curl -X POST -H 'Content-Type: application/json' -H "Authorization: Bearer $CERN_BEARER_TOKEN" "https://monit-grafana.cern.ch/api/datasources/proxy/9582/_msearch" --data $request
-    response_body = BytesIO()
-    response_header = BytesIO()
-    c = pycurl.Curl()
-    c.setopt(c.URL, base_url)
-    c.setopt(c.POSTFIELDS, request)
-    c.setopt(c.HTTPHEADER, header)
-    c.setopt(c.WRITEDATA, response_body)
-    c.setopt(c.WRITEHEADER, response_header)
-    c.perform()
-    c.close()
-    logger.debug(f"recieved haeder:\n{response_header.getvalue()}\n")
-    logger.debug(f"recieved data:\n{response_body.getvalue()}\n")
+    key = ("POST", base_url, tuple(header), request)
+    response = _coalesce(
+        key,
+        lambda: _send_cached(
+            key,
+            lambda conditional_headers: _post_with_curl(
+                base_url,
+                header
+                + [f"{name}: {value}" for name, value in conditional_headers.items()],
+                request,
+                logger,
+            ),
+        ),
+    )
+    _record(response.content_hash)
+    # the response can be large, so it is only formatted if it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"recieved haeder:\n{response.headers}\n")
+        logger.debug(f"recieved data:\n{response.content}\n")
     # check if the http code is 200 else raise an error
-    if "200" not in response_header.getvalue().decode("utf8").split("\n")[0]:
-        logger.error(f"recieved haeder:\n{response_header.getvalue().decode('utf8')}\n")
-        logger.error(f"recieved data:\n{response_body.getvalue().decode('utf8')}\n")
-        raise Exception(
-            f"Server retourned an error code:\n{response_header.getvalue().decode('utf8')}"
-        )
+    if response.status_code != 200:
+        logger.error(f"recieved haeder:\n{response.headers}\n")
+        logger.error(f"recieved data:\n{response.text}\n")
+        raise Exception(f"Server retourned an error code:\n{response.status_code}")
 
-    # try to interpret the resieved data as json
+    # try to interpret the resieved data as json, json can read the utf8 bytes directly
     try:
-        result = json.loads(response_body.getvalue().decode("utf8"))
+        result = response.json()
     except Exception as e:
         logger.error(e)
         logger.error("The HTTP response didn't contain the expected JSON.")
@@ -44,6 +419,440 @@ def get_data_from_elasticsearch(base_url, header, query_head, query_body, logger
     return result
 
 
+def _post_with_curl(base_url, header, request, logger):
+    # returns the status code, headers and body of the response
+    retries = getattr(settings, "HTTP_RETRIES", 3)
+    for attempt in range(retries + 1):
+        response_body = BytesIO()
+        response_header = BytesIO()
+        c = get_curl()
+        c.setopt(c.URL, base_url)
+        c.setopt(c.POSTFIELDS, request)
+        c.setopt(c.HTTPHEADER, header)
+        c.setopt(c.WRITEDATA, response_body)
+        c.setopt(c.WRITEHEADER, response_header)
+        try:
+            c.perform()
+        except pycurl.error as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Request to {base_url} failed ({e}), retrying.")
+        else:
+            if (
+                c.getinfo(c.RESPONSE_CODE) not in RETRY_STATUS_CODES
+                or attempt == retries
+            ):
+                break
+            logger.warning(
+                f"Request to {base_url} returned {c.getinfo(c.RESPONSE_CODE)}, retrying."
+            )
+        # exponential backoff between the retries
+        time.sleep(getattr(settings, "HTTP_BACKOFF", 0.5) * 2**attempt)
+    metrics.add_payload(response_body.tell())
+    return (
+        c.getinfo(c.RESPONSE_CODE),
+        _parse_header(response_header.getvalue()),
+        response_body.getvalue(),
+    )
+
+
+def _parse_header(raw_header):
+    # the raw header can contain several responses, e.g. after redirects, the last one
+    # is parsed
+    blocks = [
+        block
+        for block in raw_header.decode("latin1").split("\r\n\r\n")
+        if block.strip()
+    ]
+    lines = blocks[-1].split("\r\n")[1:] if blocks else []
+    return CaseInsensitiveDict(
+        (name.strip(), value.strip())
+        for name, value in (line.split(":", 1) for line in lines if ":" in line)
+    )
+
+
+def iter_data_from_elasticsearch(
+    base_url, header, query_head, query_body, logger, prefix="responses.item"
+):
+    """Streaming variant of :func:`get_data_from_elasticsearch` for large responses. The
+    response is parsed while it is received and only the items at ``prefix`` are built,
+    so the whole response is never in memory.
+
+    Args:
+        base_url (str): Url of the ``_msearch`` endpoint.
+        header (list of str): HTTP headers like ``"Authorization: Bearer ..."``.
+        query_head (dict): The header of the multi search query.
+        query_body (dict): The body of the multi search query.
+        logger (logging.Logger): The logger of the analysis.
+        prefix (str, optional): Path of the items to yield, e.g.
+            ``"responses.item.hits.hits.item"`` for the hits or
+            ``"responses.item.aggregations.<name>.buckets.item"`` for the buckets of an
+            aggregation. Defaults to the single responses.
+
+    Yields:
+        json like dict or list: The items at the prefix.
+    """
+    request = "\n" + json.dumps(query_head) + "\n" + json.dumps(query_body) + "\n"
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"using query:\n{request}")
+    _record(None)
+    with get_session().post(
+        base_url,
+        data=request,
+        headers=header_dict(header),
+        stream=True,
+        timeout=get_timeout(),
+    ) as r:
+        _raise_for_status(r, logger)
+        # let urllib3 decompress the raw stream if it is compressed
+        r.raw.decode_content = True
+        try:
+            yield from ijson.items(r.raw, prefix, use_float=True)
+        finally:
+            metrics.add_payload(r.raw.tell())
+
+
+def scroll_elasticsearch(
+    base_url,
+    index,
+    query,
+    header,
+    logger,
+    page_size=1000,
+    slices=1,
+    keep_alive="1m",
+    use_scroll=False,
+):
+    """Fetches all hits of a search, also more than the 10000 hits a single search
+    returns. The hits are fetched page by page with a point in time and ``search_after``
+    or, if ``use_scroll`` is set (e.g. for Elasticsearch before 7.10), with the scroll API.
+    With ``slices`` the search is split into slices which are fetched in parallel threads.
+
+    Args:
+        base_url (str): Url of the Elasticsearch API, e.g. the grafana datasource proxy
+                        `https://monit-grafana.cern.ch/api/datasources/proxy/9582`.
+        index (str): The index (pattern) to search.
+        query (dict): The body of the search, e.g. ``{"query": {...}}``. Without a
+                      ``sort`` the hits are sorted in index order, which is the fastest.
+        header (list of str): HTTP headers like ``"Authorization: Bearer ..."``.
+        logger (logging.Logger): The logger of the analysis.
+        page_size (int, optional): Number of hits per request. Defaults to 1000.
+        slices (int, optional): Number of slices fetched in parallel. Defaults to 1.
+        keep_alive (str, optional): How long the search context is kept between two
+                                    pages. Defaults to "1m".
+        use_scroll (bool, optional): Use the scroll API. Defaults to False.
+
+    Yields:
+        dict: The hits, in no particular order if there is more than one slice.
+    """
+    search = _scroll_slice if use_scroll else _search_after_slice
+    _record(None)
+    headers = header_dict(header)
+    headers.setdefault("Content-Type", "application/json")
+    base_url = base_url.rstrip("/")
+
+    pit_id = None
+    if not use_scroll:
+        r = get_session().post(
+            f"{base_url}/{index}/_pit",
+            params={"keep_alive": keep_alive},
+            headers=headers,
+            timeout=get_timeout(),
+        )
+        _raise_for_status(r, logger)
+        pit_id = r.json()["id"]
+    try:
+        if slices <= 1:
+            for hits in search(
+                base_url, index, query, headers, logger, page_size, keep_alive, pit_id
+            ):
+                yield from hits
+            return
+
+        # the slices put their pages into the queue, None marks the end of a slice
+        pages = queue.Queue(maxsize=2 * slices)
+        stop = threading.Event()
+
+        def put(item):
+            # waits for space in the queue, but gives up when the consumer stopped
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch_slice(slice_id):
+            try:
+                for hits in search(
+                    base_url,
+                    index,
+                    dict(query, slice={"id": slice_id, "max": slices}),
+                    headers,
+                    logger,
+                    page_size,
+                    keep_alive,
+                    pit_id,
+                ):
+                    if not put(hits):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        # the threads run in a copy of the context, so the fetched pages are measured
+        threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(fetch_slice, i),
+                daemon=True,
+            )
+            for i in range(slices)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            running = slices
+            while running:
+                hits = pages.get()
+                if hits is None:
+                    running -= 1
+                elif isinstance(hits, Exception):
+                    raise hits
+                else:
+                    yield from hits
+        finally:
+            # stop the other slices if the hits are not needed anymore or a slice failed
+            stop.set()
+            for thread in threads:
+                thread.join()
+    finally:
+        if pit_id:
+            get_session().delete(
+                f"{base_url}/_pit",
+                json={"id": pit_id},
+                headers=headers,
+                timeout=get_timeout(),
+            )
+
+
+def _search_after_slice(
+    base_url, index, query, headers, logger, page_size, keep_alive, pit_id
+):
+    # yields the pages of hits of the point in time, fetched with search_after
+    body = dict(
+        query,
+        size=page_size,
+        pit={"id": pit_id, "keep_alive": keep_alive},
+        track_total_hits=False,
+    )
+    body.setdefault("sort", [{"_shard_doc": "asc"}])
+    while True:
+        r = get_session().post(
+            f"{base_url}/_search", json=body, headers=headers, timeout=get_timeout()
+        )
+        _raise_for_status(r, logger)
+        metrics.add_payload(len(r.content))
+        result = r.json()
+        hits = result["hits"]["hits"]
+        if hits:
+            yield hits
+        if len(hits) < page_size:
+            return
+        body["pit"]["id"] = result.get("pit_id", body["pit"]["id"])
+        body["search_after"] = hits[-1]["sort"]
+
+
+def _scroll_slice(
+    base_url, index, query, headers, logger, page_size, keep_alive, pit_id
+):
+    # yields the pages of hits fetched with the scroll API
+    r = get_session().post(
+        f"{base_url}/{index}/_search",
+        params={"scroll": keep_alive},
+        json=dict(query, size=page_size),
+        headers=headers,
+        timeout=get_timeout(),
+    )
+    scroll_id = None
+    try:
+        while True:
+            _raise_for_status(r, logger)
+            metrics.add_payload(len(r.content))
+            result = r.json()
+            scroll_id = result.get("_scroll_id", scroll_id)
+            hits = result["hits"]["hits"]
+            if hits:
+                yield hits
+            if len(hits) < page_size:
+                return
+            r = get_session().post(
+                f"{base_url}/_search/scroll",
+                json={"scroll": keep_alive, "scroll_id": scroll_id},
+                headers=headers,
+                timeout=get_timeout(),
+            )
+    finally:
+        if scroll_id:
+            get_session().delete(
+                f"{base_url}/_search/scroll",
+                json={"scroll_id": scroll_id},
+                headers=headers,
+                timeout=get_timeout(),
+            )
+
+
+def _raise_for_status(r, logger):
+    if r.status_code != 200:
+        logger.error(f"recieved haeder:\n{r.headers}\n")
+        logger.error(f"recieved data:\n{r.text}\n")
+        raise Exception(f"Server retourned an error code:\n{r.status_code}")
+
+
+def es_query_since(query_body, since, field="@timestamp"):
+    """Adds a lower bound to the time of an Elasticsearch query, so it only finds
+    documents newer than ``since``, e.g. the ``since`` of the instance (see
+    :func:`~Happyface4.app_configs.AnalysisConfig.get_high_water_mark`). Other time
+    ranges of the query are kept, so the newer bound of both applies.
+
+    Args:
+        query_body (dict): The body of the search, e.g. ``{"query": {...}, "aggs": ...}``.
+        since (datetime.datetime): Only documents after this time are found. If it is
+                                   None, the query is returned unchanged.
+        field (str, optional): The time field. Defaults to "@timestamp".
+
+    Returns:
+        dict: A copy of the body with the range filter.
+    """
+    if since is None:
+        return query_body
+    query_body = copy.deepcopy(query_body)
+    time_range = {
+        "range": {
+            field: {"gt": int(since.timestamp() * 1000), "format": "epoch_millis"}
+        }
+    }
+    query = query_body.get("query")
+    if query is None:
+        query_body["query"] = {"bool": {"filter": [time_range]}}
+    elif list(query) == ["bool"]:
+        # the filter of the bool query can be a single query or a list
+        filters = query["bool"].get("filter", [])
+        if isinstance(filters, dict):
+            filters = [filters]
+        query["bool"]["filter"] = filters + [time_range]
+    else:
+        query_body["query"] = {"bool": {"must": [query], "filter": [time_range]}}
+    return query_body
+
+
+# the clauses of an InfluxQL select statement which follow the where clause
+# the tokens of InfluxQL, quoted strings and identifiers end at the end of the query if
+# they aren't closed
+_INFLUXQL_TOKEN = re.compile(
+    r"""'(?:\\.|[^'\\])*'?|"(?:\\.|[^"\\])*"?|[=!]~|\w+|\s+|.""", re.DOTALL
+)
+_INFLUXQL_REGEX = re.compile(r"/(?:\\.|[^/\\])*/?", re.DOTALL)
+# the tokens after which a slash starts a regular expression instead of a division
+_INFLUXQL_BEFORE_REGEX = {"=~", "!~", ",", "SELECT", "FROM", "BY"}
+_INFLUXQL_FROM = re.compile(r"\bFROM\b\s*", re.IGNORECASE)
+_INFLUXQL_WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+_INFLUXQL_AFTER_WHERE = re.compile(
+    r"\b(?:GROUP\s+BY|ORDER\s+BY|LIMIT|OFFSET|SLIMIT|SOFFSET)\b|\b(?:fill|tz)\s*\(",
+    re.IGNORECASE,
+)
+
+
+def influxql_since(query, since):
+    """Adds a lower bound ``time > since`` to the where clauses of the select statements
+    of an InfluxQL query, e.g. with the ``since`` of the instance (see
+    :func:`~Happyface4.app_configs.AnalysisConfig.get_high_water_mark`). Other
+    conditions on the time are kept, so the newer bound of both applies. Subqueries
+    aren't changed.
+
+    Args:
+        query (str): The InfluxQL query, it can have several statements separated by
+                     semicolons.
+        since (datetime.datetime): Only points after this time are selected. If it is
+                                   None, the query is returned unchanged.
+
+    Returns:
+        str: The query with the lower bound.
+    """
+    if since is None:
+        return query
+    condition = f"time > {int(since.timestamp() * 1000)}ms"
+    # keywords and semicolons are searched in the masked query, in which the strings,
+    # quoted identifiers and regular expressions are replaced
+    masked = _influxql_mask(query)
+    statements = []
+    start = 0
+    for separator in re.finditer(";", masked + ";"):
+        end = separator.start()
+        statements.append(
+            _influxql_statement_since(query[start:end], masked[start:end], condition)
+        )
+        start = end + 1
+    return ";".join(statements)
+
+
+def _influxql_mask(query):
+    # replaces the string literals, quoted identifiers and regular expressions of the
+    # query with underscores, so the positions of the other tokens stay the same
+    masked = []
+    before_regex = False
+    position = 0
+    while position < len(query):
+        if before_regex and query[position] == "/":
+            token = _INFLUXQL_REGEX.match(query, position).group()
+            masked.append("_" * len(token))
+        else:
+            token = _INFLUXQL_TOKEN.match(query, position).group()
+            masked.append("_" * len(token) if token[0] in "'\"" else token)
+        if not token.isspace():
+            before_regex = token.upper() in _INFLUXQL_BEFORE_REGEX
+        position += len(token)
+    return "".join(masked)
+
+
+def _influxql_split(query):
+    # splits the query into its statements at the semicolons outside of string
+    # literals, quoted identifiers and regular expressions
+    masked = _influxql_mask(query)
+    statements = []
+    start = 0
+    for separator in re.finditer(";", masked + ";"):
+        statements.append(query[start : separator.start()])
+        start = separator.start() + 1
+    return statements
+
+
+def _influxql_statement_since(statement, masked, condition):
+    # adds the condition to the where clause of a select statement
+    source = _INFLUXQL_FROM.search(masked)
+    if (
+        not re.match(r"\s*SELECT\b", masked, re.IGNORECASE)
+        or source is None
+        or masked.startswith("(", source.end())
+    ):
+        return statement
+    # the clauses are only searched after FROM, so fields and measurements can't match
+    where = _INFLUXQL_WHERE.search(masked, source.end())
+    start = where.end() if where else None
+    end = _INFLUXQL_AFTER_WHERE.search(masked, start or source.end())
+    end = end.start() if end else len(statement.rstrip())
+    if where:
+        # the old conditions are put in parentheses, so an OR doesn't bypass the bound
+        statement = (
+            f"{statement[:start]} {condition} AND ({statement[start:end].strip()}) "
+            f"{statement[end:]}"
+        )
+    else:
+        statement = f"{statement[:end].rstrip()} WHERE {condition} {statement[end:]}"
+    return statement.rstrip()
+
+
 def get_data_from_grafana(url, db_name, query, token=None, **other_params):
     """Simple helper function to get the resource data from a grafana service in JSON format.
 
@@ -73,5 +882,60 @@ def get_data_from_grafana(url, db_name, query, token=None, **other_params):
     if other_params:
         params.update(**other_params)
 
-    r = requests.get(url, headers=headers, params=params)
+    r = fetch("GET", url, headers=headers, params=params)
     return r.json()
+
+
+def get_data_from_grafana_batch(url, db_name, queries, token=None, **other_params):
+    """Batch variant of :func:`get_data_from_grafana`, which sends several InfluxQL
+    queries separated by semicolons in one request and splits the results per query by
+    their ``statement_id``.
+
+    If the instances of an analysis need different queries of the same source, each
+    instance can send the queries of all instances and take its own result. The batch
+    is only sent once if the instances are fetched in the same cycle (see
+    :func:`fetch_cycle`). getDataRoutine does this only with ``FETCH_COALESCE`` for
+    instances with the same ``source``, otherwise each instance sends the whole batch.
+
+    Args:
+        url (str): Url to the grafana instance, see :func:`get_data_from_grafana`.
+        db_name (str): Name of the db you want to fetch data from.
+        queries (list of str): The queries, each can have several statements.
+        token (str, optional): The identification token to for the grafana instance if necessary. Defaults to None.
+        **other_params: Additional parameters for the grafana api, e.g. `epoch="s"`.
+
+    Returns:
+        list of dict: The result of each query, like the result of
+                      :func:`get_data_from_grafana` with only this query.
+    """
+    # the statements of each query, empty statements would shift the statement ids
+    statements = [
+        [statement for statement in _influxql_split(query) if statement.strip()]
+        for query in queries
+    ]
+    result = get_data_from_grafana(
+        url,
+        db_name,
+        ";\n".join(statement for query in statements for statement in query),
+        token,
+        **other_params,
+    )
+    if "results" not in result:
+        # e.g. the query couldn't be parsed, so no statement has a result
+        return [result for _ in queries]
+    results = {
+        statement_result.get("statement_id", i): statement_result
+        for i, statement_result in enumerate(result["results"])
+    }
+    batch_results = []
+    first_id = 0
+    for query in statements:
+        query_results = []
+        for statement_id in range(len(query)):
+            statement_result = dict(
+                results.get(first_id + statement_id, {}), statement_id=statement_id
+            )
+            query_results.append(statement_result)
+        batch_results.append({"results": query_results})
+        first_id += len(query)
+    return batch_results
@@ -1,27 +1,144 @@
 import logging
+import threading
 from datetime import timedelta
+from time import monotonic
 
 from django.conf import settings
-
-# from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Max, Q, Sum, Value, When
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
 
 from .status import STATUS
-from .utilities import DummyInstanceStatus
+from .utilities import (
+    DummyInstanceStatus,
+    InstanceStatusList,
+    get_Analyses_from_apps,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class NameManager(models.Manager):
+    """
+    Manager of the Instance and Category models, which keeps a registry of the ids of
+    all names in memory, so the statuses can be saved and queried without looking up the
+    names in the database.
+
+    :param instance_key: The key of the instance dicts of the analyses, whose values are
+                         the names of the rows.
+    :type instance_key: str
+    """
+
+    # seconds for which names, which don't exist, aren't looked up again
+    missing_ttl = 60
+
+    def __init__(self, instance_key):
+        super().__init__()
+        self.instance_key = instance_key
+        self._ids = None
+        # monotonic times of the lookups of names, which didn't exist
+        self._missing = {}
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Loads the ids of all names and creates the rows of the names of the analysis
+        instances, which don't exist yet.
+        """
+        from django.apps import apps
+
+        names = {
+            instance[self.instance_key]
+            for analysis in get_Analyses_from_apps(apps)
+            for instance in analysis.instances
+        }
+        with self._lock:
+            self._ids = dict(self.values_list("name", "id"))
+            self._missing = {}
+            missing = names - self._ids.keys()
+            if missing:
+                # other processes may create the same names at the same time
+                self.bulk_create(
+                    [self.model(name=name) for name in missing], ignore_conflicts=True
+                )
+                self._ids = dict(self.values_list("name", "id"))
+
+    def get_ids(self, names, create=True):
+        """
+        Returns the ids of the names. Names which are not in the registry are looked up
+        in the database, because they may have been created by another process. Names
+        which don't exist are looked up again after :attr:`missing_ttl` seconds.
+
+        :param names: The names.
+        :type names: iterable of str
+        :param create: Whether the rows of names, which don't exist, are created. If not,
+                       these names are missing in the returned dict.
+        :type create: bool
+        :returns: A dict mapping the names to their ids.
+        :rtype: dict
+        """
+        if self._ids is None:
+            self.warm()
+        with self._lock:
+            now = monotonic()
+            for name in set(names) - self._ids.keys():
+                if create:
+                    self._ids[name] = self.get_or_create(name=name)[0].id
+                    self._missing.pop(name, None)
+                elif (
+                    now - self._missing.get(name, now - self.missing_ttl)
+                    >= self.missing_ttl
+                ):
+                    row_id = self.filter(name=name).values_list("id", flat=True).first()
+                    if row_id is None:
+                        self._missing[name] = now
+                    else:
+                        self._ids[name] = row_id
+                        self._missing.pop(name, None)
+            return {name: self._ids[name] for name in names if name in self._ids}
+
+    def get_id(self, name):
+        """Returns the id of an existing name or ``None``."""
+        return self.get_ids([name], create=False).get(name)
+
+
 class InstanceStatusManager(models.Manager):
     def update_or_create(self, time, instance, category, status):
+        self.bulk_update_or_create([(time, instance, category, status)])
+
+    def bulk_update_or_create(self, statuses):
+        """
+        Saves the statuses with a single query, existing statuses of an instance, category
+        and time are updated.
+
+        :param statuses: ``(time, instance_name, category, status)`` tuples.
+        :type statuses: list of tuple
+        """
         from . import models as m
 
-        ins, created = m.Instance.objects.get_or_create(name=instance)
-        cat, created = m.Category.objects.get_or_create(name=category)
-        super().update_or_create(
-            time=time, instance=ins, category=cat, defaults={"status": status}
-        )
+        instance_ids = m.Instance.objects.get_ids({s[1] for s in statuses})
+        category_ids = m.Category.objects.get_ids({s[2] for s in statuses})
+        # a row can't be updated twice in one query, so the last status of a key is used
+        rows = {}
+        for time, instance, category, status in statuses:
+            key = (instance_ids[instance], category_ids[category], time)
+            rows[key] = self.model(
+                time=time,
+                instance_id=instance_ids[instance],
+                category_id=category_ids[category],
+                status=status,
+            )
+        with transaction.atomic():
+            self.bulk_create(
+                rows.values(),
+                update_conflicts=True,
+                unique_fields=["instance", "category", "time"],
+                update_fields=["status"],
+                batch_size=1000,
+            )
+            m.InstanceStatusSnapshot.objects.update_latest(rows.values())
 
     def get_instance_status(self, time, instance_name, category, time_range):
         from . import models as m
@@ -29,14 +146,24 @@ class InstanceStatusManager(models.Manager):
         # add a small buffer to the time_range to make sure that the time_range is inclusive
         time_range += timedelta(minutes=1)
         try:
-            ins = m.Instance.objects.get(name=instance_name)
-            cat = m.Category.objects.get(name=category)
+            ins = m.Instance.objects.get_id(instance_name)
+            cat = m.Category.objects.get_id(category)
+            if ins is None or cat is None:
+                raise ObjectDoesNotExist
             status_list = (
-                self.filter(instance=ins, category=cat)
+                self.filter(instance_id=ins, category_id=cat)
                 .filter(time__gt=time - time_range)
                 .filter(time__lte=time)
                 .order_by("time")
             )
+            if time - time_range < timezone.now() - settings.STATUS_RETENTION:
+                # older statuses were rolled up by the compactStatuses command
+                status_list = m.InstanceStatusRollup.objects.add_rollups(
+                    status_list,
+                    start=time - time_range,
+                    instance_id=ins,
+                    category_id=cat,
+                )
             # check if the QurySet contains any result
             if status_list.exists():
                 return status_list
@@ -54,3 +181,351 @@ class InstanceStatusManager(models.Manager):
                 time=time, status=STATUS.TECHNICAL_ISSUE
             )
         return status_interval
+
+    def get_instance_statuses(self, time, instances):
+        """
+        Bulk variant of :meth:`get_instance_status`. Fetches the statuses of all given
+        instances with one query over the widest time window and groups them per
+        instance afterwards.
+
+        :param time: The time up to which the statuses are requested.
+        :type time: ~datetime.datetime
+        :param instances: ``(instance_name, category, time_range)`` tuples.
+        :type instances: iterable of tuple
+        :returns: A dict mapping ``(instance_name, category)`` to the time ordered
+                  statuses of the instance or a DummyInstanceStatus if there are none.
+        :rtype: dict
+        """
+        # add the same small buffer as in get_instance_status to each time_range
+        window_starts = {
+            (instance_name, category): time - time_range - timedelta(minutes=1)
+            for instance_name, category, time_range in instances
+        }
+        if not window_starts:
+            return {}
+
+        rows = (
+            self._filter_names(window_starts)
+            .filter(time__gt=min(window_starts.values()))
+            .filter(time__lte=time)
+            .order_by("time")
+            .values_list("instance_id", "category_id", "time", "status")
+        )
+        names = self._names(window_starts)
+        statuses = {key: InstanceStatusList() for key in window_starts}
+        for instance_id, category_id, status_time, status in rows:
+            key = (names[0].get(instance_id), names[1].get(category_id))
+            # the query covers the widest window, so filter by the window of each instance
+            if key in statuses and status_time > window_starts[key]:
+                statuses[key].append(self.model(time=status_time, status=status))
+
+        if min(window_starts.values()) < timezone.now() - settings.STATUS_RETENTION:
+            # older statuses were rolled up by the compactStatuses command
+            self._add_rollups(statuses, window_starts, time)
+
+        for (instance_name, category), status_list in statuses.items():
+            if not status_list:
+                logger.warning(
+                    f"No instance status for instance {instance_name} in the database (category: {category}, time: {window_starts[(instance_name, category)]} to {time})"
+                )
+                statuses[(instance_name, category)] = DummyInstanceStatus(
+                    time=time, status=STATUS.TECHNICAL_ISSUE
+                )
+        return statuses
+
+    def _add_rollups(self, statuses, window_starts, time):
+        # add the rolled up statuses of all instances, which are older than their oldest
+        # status, with one query to the grouped statuses
+        from . import models as m
+
+        rollups = (
+            self._filter_names(window_starts, m.InstanceStatusRollup.objects)
+            .filter(time__gt=min(window_starts.values()))
+            .filter(time__lte=time)
+            .order_by("time")
+            .values_list("instance_id", "category_id", "time", "status")
+        )
+        names = self._names(window_starts)
+        rolled_up = {key: InstanceStatusList() for key in window_starts}
+        for instance_id, category_id, rollup_time, status in rollups:
+            key = (names[0].get(instance_id), names[1].get(category_id))
+            if (
+                key in statuses
+                and rollup_time > window_starts[key]
+                and (not statuses[key] or rollup_time < statuses[key][0].time)
+            ):
+                rolled_up[key].append(
+                    m.InstanceStatusRollup(time=rollup_time, status=status)
+                )
+        for key, rollup_list in rolled_up.items():
+            statuses[key][:0] = rollup_list
+
+    def _filter_names(self, keys, manager=None):
+        # filters the statuses by the ids of the instance and category names of the keys
+        from . import models as m
+
+        return (manager or self).filter(
+            instance_id__in=m.Instance.objects.get_ids(
+                {name for name, _ in keys}, create=False
+            ).values(),
+            category_id__in=m.Category.objects.get_ids(
+                {cat for _, cat in keys}, create=False
+            ).values(),
+        )
+
+    def _names(self, keys):
+        # maps the ids of the instance and category names of the keys back to the names
+        from . import models as m
+
+        return [
+            {
+                row_id: name
+                for name, row_id in manager.get_ids(names, create=False).items()
+            }
+            for manager, names in (
+                (m.Instance.objects, {name for name, _ in keys}),
+                (m.Category.objects, {cat for _, cat in keys}),
+            )
+        ]
+
+
+class InstanceStatusRollupManager(models.Manager):
+    def add_rollups(self, statuses, start, **filters):
+        """
+        Adds the rolled up statuses after ``start``, which are older than the oldest
+        status, in front of the statuses.
+
+        :param statuses: The time ordered statuses.
+        :type statuses: QuerySet or list
+        :param start: The start of the time range.
+        :type start: ~datetime.datetime
+        :param filters: Filters for the instance and category of the statuses.
+        :returns: The rolled up statuses followed by the statuses.
+        :rtype: InstanceStatusList
+        """
+        statuses = list(statuses)
+        rollups = self.filter(**filters).filter(time__gt=start).order_by("time")
+        if statuses:
+            rollups = rollups.filter(time__lt=statuses[0].time)
+        return InstanceStatusList(list(rollups) + statuses)
+
+    def roll_up(self, source, resolution, before):
+        """
+        Rolls the statuses of the source up into buckets of the resolution, each with the
+        worst status in it. Only buckets which end before ``before`` are rolled up, the
+        rolled up statuses are deleted.
+
+        :param source: The statuses to roll up, InstanceStatus objects or hourly rollups.
+        :type source: QuerySet
+        :param resolution: ``InstanceStatusRollup.HOUR`` or ``InstanceStatusRollup.DAY``
+        :type resolution: str
+        :param before: The time before which the statuses are rolled up.
+        :type before: ~datetime.datetime
+        :returns: The number of rolled up statuses.
+        :rtype: int
+        """
+        before = timezone.localtime(before).replace(minute=0, second=0, microsecond=0)
+        if resolution == self.model.DAY:
+            before = before.replace(hour=0)
+            truncate = TruncDay
+        else:
+            truncate = TruncHour
+
+        source = source.filter(time__lt=before)
+        buckets = (
+            source.annotate(bucket=truncate("time"))
+            .values_list("instance", "category", "bucket")
+            .annotate(worst=Max("status"))
+            .order_by()
+        )
+        with transaction.atomic():
+            rollups = {}
+            for instance_id, category_id, bucket, worst in buckets:
+                rollups[(instance_id, category_id, bucket)] = self.model(
+                    time=bucket,
+                    resolution=resolution,
+                    instance_id=instance_id,
+                    category_id=category_id,
+                    status=worst,
+                )
+            if not rollups:
+                return 0
+
+            # merge with buckets which were already rolled up before, e.g. because
+            # statuses were saved for a time in the past
+            existing = self.filter(resolution=resolution).filter(
+                time__gte=min(key[2] for key in rollups), time__lt=before
+            )
+            updated = []
+            for rollup in existing:
+                key = (rollup.instance_id, rollup.category_id, rollup.time)
+                if key in rollups:
+                    rollup.status = max(rollup.status, rollups.pop(key).status)
+                    updated.append(rollup)
+            self.bulk_update(updated, ["status"], batch_size=1000)
+            self.bulk_create(rollups.values(), batch_size=1000)
+            deleted, _ = source.delete()
+        return deleted
+
+
+class InstanceStatusSnapshotManager(models.Manager):
+    def update_latest(self, statuses):
+        """
+        Updates the snapshots of the instances with the statuses, which are newer than
+        the snapshots. The time of each snapshot is compared in the update query itself,
+        so a concurrent writer with older statuses can't move a snapshot back in time.
+
+        :param statuses: InstanceStatus objects.
+        :type statuses: iterable
+        """
+        latest = {}
+        for status in statuses:
+            key = (status.instance_id, status.category_id)
+            if key not in latest or status.time > latest[key].time:
+                latest[key] = status
+        if not latest:
+            return
+        latest = list(latest.values())
+        # creates the missing snapshots, the existing ones are updated below
+        self.bulk_create(
+            [
+                self.model(
+                    time=status.time,
+                    instance_id=status.instance_id,
+                    category_id=status.category_id,
+                    status=status.status,
+                )
+                for status in latest
+            ],
+            ignore_conflicts=True,
+        )
+        for i in range(0, len(latest), 500):
+            batch = latest[i : i + 500]
+            # e.g. a timed out instance whose status is saved after a newer one
+            newer = Q()
+            times = []
+            status_values = []
+            for status in batch:
+                key = Q(instance_id=status.instance_id, category_id=status.category_id)
+                newer |= key & Q(time__lte=status.time)
+                times.append(When(key, then=Value(status.time)))
+                status_values.append(When(key, then=Value(status.status)))
+            self.filter(newer).update(
+                time=Case(*times, output_field=models.DateTimeField()),
+                status=Case(*status_values, output_field=models.SmallIntegerField()),
+            )
+
+    def get_latest_statuses(self, time, instances):
+        """
+        Variant of :meth:`InstanceStatusManager.get_instance_statuses`, which only returns
+        the latest status of the instances from their snapshots. Instances without a
+        status in their time range get a technical issue status.
+
+        :param time: The time up to which the statuses are requested, usually now.
+        :type time: ~datetime.datetime
+        :param instances: ``(instance_name, category, time_range)`` tuples.
+        :type instances: iterable of tuple
+        :returns: A dict mapping ``(instance_name, category)`` to a DummyInstanceStatus
+                  with the latest status. Instances whose snapshot is newer than
+                  ``time`` are missing, their statuses have to be searched in the
+                  history.
+        :rtype: dict
+        """
+        from . import models as m
+
+        window_starts = {
+            (instance_name, category): time - time_range - timedelta(minutes=1)
+            for instance_name, category, time_range in instances
+        }
+        if not window_starts:
+            return {}
+        instance_ids = m.Instance.objects.get_ids(
+            {name for name, _ in window_starts}, create=False
+        )
+        category_ids = m.Category.objects.get_ids(
+            {cat for _, cat in window_starts}, create=False
+        )
+        snapshots = {
+            (instance, category): (snapshot_time, status)
+            for instance, category, snapshot_time, status in self.filter(
+                instance_id__in=instance_ids.values(),
+                category_id__in=category_ids.values(),
+            ).values_list("instance_id", "category_id", "time", "status")
+        }
+
+        statuses = {}
+        for (instance_name, category), window_start in window_starts.items():
+            snapshot_time, status = snapshots.get(
+                (instance_ids.get(instance_name), category_ids.get(category)),
+                (None, None),
+            )
+            if snapshot_time is not None and snapshot_time > time:
+                continue
+            if snapshot_time is None or snapshot_time <= window_start:
+                # the same status as if the history has no status in the time range
+                logger.warning(
+                    f"No instance status for instance {instance_name} in the database (category: {category}, time: {window_start} to {time})"
+                )
+                snapshot_time, status = time, STATUS.TECHNICAL_ISSUE
+            statuses[(instance_name, category)] = DummyInstanceStatus(
+                time=snapshot_time, status=status
+            )
+        return statuses
+
+
+class MetricManager(models.Manager):
+    def totals(self):
+        """
+        Returns the metrics summed up over all processes per phase, analysis and
+        instance.
+
+        :rtype: QuerySet of dict
+        """
+        return (
+            self.values("phase", "analysis", "instance")
+            .annotate(
+                count=Sum("count"),
+                errors=Sum("errors"),
+                seconds_total=Sum("seconds_total"),
+                seconds_max=Max("seconds_max"),
+                payload_bytes=Sum("payload_bytes"),
+                queries=Sum("queries"),
+            )
+            .order_by("phase", "analysis", "instance")
+        )
+
+    def delete_stale(self, before):
+        """
+        Deletes the metrics of the processes, which didn't save them since ``before``,
+        e.g. because they were restarted.
+
+        :param before: Processes whose latest update is older are deleted.
+        :type before: ~datetime.datetime
+        """
+        stale = (
+            self.values("process")
+            .annotate(latest=Max("updated"))
+            .filter(latest__lt=before)
+            .values("process")
+        )
+        self.filter(process__in=stale).delete()
+
+
+class HighWaterMarkManager(models.Manager):
+    def get_time(self, instance):
+        """Returns the high-water mark of the instance or ``None`` if it has none."""
+        from .models import Instance
+
+        return (
+            self.filter(instance_id=Instance.objects.get_id(instance))
+            .values_list("time", flat=True)
+            .first()
+        )
+
+    def advance(self, instance, time):
+        """Sets the high-water mark of the instance to ``time``, if it is newer."""
+        from .models import Instance
+
+        instance_id = Instance.objects.get_ids([instance])[instance]
+        if not self.filter(instance_id=instance_id, time__lt=time).update(time=time):
+            self.get_or_create(instance_id=instance_id, defaults={"time": time})
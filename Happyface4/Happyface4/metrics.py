@@ -0,0 +1,249 @@
+import contextvars
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+logger = logging.getLogger("Happyface4")
+
+# the innermost running measurement of the context
+_current = contextvars.ContextVar("measurement", default=None)
+# totals of this process per (phase, analysis, instance) and the keys changed since the
+# last flush
+_totals = {}
+_changed = set()
+_lock = threading.Lock()
+_last_flush = 0.0
+
+
+class Measurement(object):
+    """
+    Collects the payload size, the number of database queries and whether an error
+    occurred during a :func:`measure` block.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.payload_bytes = 0
+        self.queries = 0
+        self.error = False
+        self._lock = threading.Lock()
+
+    def add_payload(self, size):
+        # the payload can be added from other threads, e.g. parallel scroll slices
+        with self._lock:
+            self.payload_bytes += size
+        if self.parent is not None:
+            self.parent.add_payload(size)
+
+    def __call__(self, execute, sql, params, many, context):
+        # used as execute wrapper of the database connection
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def measure(phase, analysis, instance):
+    """
+    Measures the duration, payload size, database queries and errors of the block and
+    adds them to the metrics of the phase of the instance. Exceptions count as errors,
+    further errors can be marked by setting ``error`` of the yielded Measurement.
+
+    .. code-block:: python
+
+        with metrics.measure("extract", self.name, instance["name"]) as measurement:
+            ...
+
+    :param phase: The measured phase, e.g. ``"extract"``.
+    :type phase: str
+    :param analysis: The name of the analysis.
+    :type analysis: str
+    :param instance: The name of the instance.
+    :type instance: str
+    """
+    if not settings.METRICS_ENABLED:
+        yield Measurement()
+        return
+    measurement = Measurement(_current.get())
+    token = _current.set(measurement)
+    start = time.perf_counter()
+    try:
+        # only the queries of this thread are counted
+        with connection.execute_wrapper(measurement):
+            yield measurement
+    except Exception:
+        measurement.error = True
+        raise
+    finally:
+        _current.reset(token)
+        record(
+            phase,
+            analysis,
+            instance,
+            time.perf_counter() - start,
+            measurement.payload_bytes,
+            measurement.queries,
+            measurement.error,
+        )
+        # the metrics are saved outside of measurements, so the queries aren't counted
+        if measurement.parent is None:
+            flush()
+
+
+def add_payload(size):
+    """Adds the size in bytes of fetched or rendered data to the running measurement."""
+    measurement = _current.get()
+    if measurement is not None:
+        measurement.add_payload(size)
+
+
+def record(phase, analysis, instance, seconds, payload_bytes=0, queries=0, error=False):
+    """Adds a measurement to the metrics of this process."""
+    key = (phase, analysis, instance)
+    with _lock:
+        totals = _totals.setdefault(
+            key,
+            {
+                "count": 0,
+                "errors": 0,
+                "seconds_total": 0.0,
+                "seconds_max": 0.0,
+                "payload_bytes": 0,
+                "queries": 0,
+            },
+        )
+        totals["count"] += 1
+        totals["errors"] += int(error)
+        totals["seconds_total"] += seconds
+        totals["seconds_max"] = max(totals["seconds_max"], seconds)
+        totals["payload_bytes"] += payload_bytes
+        totals["queries"] += queries
+        _changed.add(key)
+
+
+def flush(force=False):
+    """
+    Saves the metrics of this process in the database, so they can be exported by the
+    website, also if they were measured by getDataRoutine. Without ``force`` they are
+    saved at most every ``settings.METRICS_FLUSH_INTERVAL`` seconds. The metrics of
+    processes which didn't save them for ``settings.METRICS_TTL`` seconds are deleted.
+    """
+    global _last_flush
+    from .models import Metric
+
+    with _lock:
+        since_last_flush = time.monotonic() - _last_flush
+        if not _changed or (
+            not force and since_last_flush < settings.METRICS_FLUSH_INTERVAL
+        ):
+            return
+        # the rows of this process may have been deleted as stale, so all are saved
+        keys = _totals.keys() if since_last_flush >= settings.METRICS_TTL else _changed
+        rows = [(key, dict(_totals[key])) for key in keys]
+        _changed.clear()
+        _last_flush = time.monotonic()
+    # each process only writes its own rows, so the totals can be saved as they are
+    process = f"{socket.gethostname()}:{os.getpid()}"
+    now = timezone.now()
+    try:
+        Metric.objects.bulk_create(
+            [
+                Metric(
+                    process=process,
+                    phase=phase,
+                    analysis=analysis,
+                    instance=instance,
+                    updated=now,
+                    **totals,
+                )
+                for (phase, analysis, instance), totals in rows
+            ],
+            update_conflicts=True,
+            unique_fields=["process", "phase", "analysis", "instance"],
+            update_fields=["updated", *rows[0][1]],
+        )
+        Metric.objects.delete_stale(now - timedelta(seconds=settings.METRICS_TTL))
+    except Exception:
+        # the metrics must not break fetching or rendering
+        logger.exception("Couldn't save the metrics.")
+        with _lock:
+            _changed.update(key for key, _ in rows)
+
+
+def is_authorized(request):
+    """
+    Whether the request may read the exported metrics. It has to send
+    ``settings.METRICS_TOKEN`` as bearer token in the ``Authorization`` header or in the
+    ``token`` query parameter. If no token is set, the metrics are only exported in
+    debug mode.
+    """
+    if not settings.METRICS_TOKEN:
+        return settings.DEBUG
+    token = request.GET.get("token", "")
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        token = authorization[len("Bearer ") :]
+    return secrets.compare_digest(token, settings.METRICS_TOKEN)
+
+
+def export():
+    """
+    Returns the metrics of all processes in the Prometheus text format.
+
+    :rtype: str
+    """
+    from .models import Metric
+
+    flush(force=True)
+    metrics = [
+        ("count", "happyface_runs_total", "counter", "Number of runs of the phase."),
+        ("errors", "happyface_errors_total", "counter", "Number of failed runs."),
+        (
+            "seconds_total",
+            "happyface_duration_seconds_total",
+            "counter",
+            "Total duration of the runs in seconds.",
+        ),
+        (
+            "seconds_max",
+            "happyface_duration_seconds_max",
+            "gauge",
+            "Longest duration of a run in seconds.",
+        ),
+        (
+            "payload_bytes",
+            "happyface_payload_bytes_total",
+            "counter",
+            "Bytes fetched from the sources or rendered.",
+        ),
+        (
+            "queries",
+            "happyface_queries_total",
+            "counter",
+            "Number of database queries.",
+        ),
+    ]
+    rows = list(Metric.objects.totals())
+    lines = []
+    for field, name, metric_type, description in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for row in rows:
+            labels = ",".join(
+                f'{label}="{_escape(row[label])}"'
+                for label in ("phase", "analysis", "instance")
+            )
+            lines.append(f"{name}{{{labels}}} {row[field]}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
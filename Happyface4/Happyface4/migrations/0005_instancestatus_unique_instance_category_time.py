@@ -0,0 +1,48 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.db.models.deletion
+
+
+def remove_duplicate_statuses(apps, schema_editor):
+    # keep only the newest status of each instance, category and time, otherwise the
+    # unique constraint can't be created
+    InstanceStatus = apps.get_model("Happyface4", "InstanceStatus")
+    duplicates = (
+        InstanceStatus.objects.values("instance", "category", "time")
+        .annotate(count=Count("id"), newest=Max("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        InstanceStatus.objects.filter(
+            instance=duplicate["instance"],
+            category=duplicate["category"],
+            time=duplicate["time"],
+        ).exclude(id=duplicate["newest"]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("Happyface4", "0004_alter_instancestatus_status"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_statuses, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="instancestatus",
+            name="instance",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="Happyface4.instance",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="instancestatus",
+            constraint=models.UniqueConstraint(
+                fields=("instance", "category", "time"),
+                name="unique_instance_category_time",
+            ),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("Happyface4", "0005_instancestatus_unique_instance_category_time"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InstanceStatusRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("time", models.DateTimeField(verbose_name="Start of the hour or day")),
+                (
+                    "resolution",
+                    models.CharField(
+                        choices=[("hour", "hour"), ("day", "day")], max_length=4
+                    ),
+                ),
+                (
+                    "status",
+                    models.SmallIntegerField(
+                        choices=[
+                            (-2, "technical issue"),
+                            (-1, "info"),
+                            (0, "ok"),
+                            (1, "warning"),
+                            (2, "critical"),
+                        ],
+                        verbose_name="worst status of the instance in the hour or day",
+                    ),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="Happyface4.category",
+                    ),
+                ),
+                (
+                    "instance",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="Happyface4.instance",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("instance", "category", "time", "resolution"),
+                        name="unique_rollup_instance_category_time",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:11
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, Min, OuterRef
+
+
+def merge_duplicate_names(apps, schema_editor):
+    # the statuses of instances and categories with the same name are moved to the
+    # oldest row of the name, otherwise the unique index can't be created
+    status_models = [
+        (apps.get_model("Happyface4", "InstanceStatus"), ["time"]),
+        (apps.get_model("Happyface4", "InstanceStatusRollup"), ["time", "resolution"]),
+    ]
+    for model_name, field, other_field in [
+        ("Instance", "instance", "category"),
+        ("Category", "category", "instance"),
+    ]:
+        Model = apps.get_model("Happyface4", model_name)
+        duplicates = (
+            Model.objects.values("name")
+            .annotate(count=Count("id"), oldest=Min("id"))
+            .filter(count__gt=1)
+        )
+        for duplicate in duplicates.iterator():
+            for row in Model.objects.filter(name=duplicate["name"]).exclude(
+                id=duplicate["oldest"]
+            ):
+                for Status, keys in status_models:
+                    # if the oldest row already has a status at the same time, the
+                    # status of the duplicate is dropped
+                    conflicts = Status.objects.filter(
+                        **{field: duplicate["oldest"]},
+                        **{key: OuterRef(key) for key in keys + [other_field]},
+                    )
+                    Status.objects.filter(**{field: row}).filter(
+                        Exists(conflicts)
+                    ).delete()
+                    Status.objects.filter(**{field: row}).update(
+                        **{field: duplicate["oldest"]}
+                    )
+                row.delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("Happyface4", "0006_instancestatusrollup"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="category",
+            name="name",
+            field=models.CharField(
+                max_length=100, unique=True, verbose_name="Category Name"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="instance",
+            name="name",
+            field=models.CharField(
+                max_length=100, unique=True, verbose_name="Analysis Name"
+            ),
+        ),
+    ]
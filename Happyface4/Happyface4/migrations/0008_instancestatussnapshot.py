@@ -0,0 +1,94 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:13
+
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def create_snapshots(apps, schema_editor):
+    # the snapshot of each instance is its latest status in the history
+    InstanceStatus = apps.get_model("Happyface4", "InstanceStatus")
+    InstanceStatusSnapshot = apps.get_model("Happyface4", "InstanceStatusSnapshot")
+    latest_times = InstanceStatus.objects.values("instance", "category").annotate(
+        latest_time=Max("time")
+    )
+    InstanceStatusSnapshot.objects.bulk_create(
+        [
+            InstanceStatusSnapshot(
+                instance_id=row["instance"],
+                category_id=row["category"],
+                time=row["latest_time"],
+                status=InstanceStatus.objects.get(
+                    instance=row["instance"],
+                    category=row["category"],
+                    time=row["latest_time"],
+                ).status,
+            )
+            for row in latest_times
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("Happyface4", "0007_unique_names"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InstanceStatusSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "time",
+                    models.DateTimeField(verbose_name="Time of the latest status"),
+                ),
+                (
+                    "status",
+                    models.SmallIntegerField(
+                        choices=[
+                            (-2, "technical issue"),
+                            (-1, "info"),
+                            (0, "ok"),
+                            (1, "warning"),
+                            (2, "critical"),
+                        ],
+                        verbose_name="latest status of the instance",
+                    ),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="Happyface4.category",
+                    ),
+                ),
+                (
+                    "instance",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="Happyface4.instance",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("instance", "category"),
+                        name="unique_snapshot_instance_category",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(create_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("Happyface4", "0008_instancestatussnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Metric",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "process",
+                    models.CharField(
+                        max_length=100, verbose_name="host and process id"
+                    ),
+                ),
+                ("phase", models.CharField(max_length=50)),
+                ("analysis", models.CharField(max_length=100)),
+                ("instance", models.CharField(max_length=100)),
+                ("count", models.BigIntegerField(verbose_name="number of runs")),
+                (
+                    "errors",
+                    models.BigIntegerField(verbose_name="number of failed runs"),
+                ),
+                (
+                    "seconds_total",
+                    models.FloatField(verbose_name="total duration of the runs"),
+                ),
+                (
+                    "seconds_max",
+                    models.FloatField(verbose_name="longest duration of a run"),
+                ),
+                (
+                    "payload_bytes",
+                    models.BigIntegerField(verbose_name="fetched or rendered bytes"),
+                ),
+                (
+                    "queries",
+                    models.BigIntegerField(verbose_name="number of database queries"),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(verbose_name="time of the last update"),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("process", "phase", "analysis", "instance"),
+                        name="unique_metric_process_phase_analysis_instance",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -3,11 +3,13 @@ from . import managers
 
 
 class Category(models.Model):
-    name = models.CharField(max_length=100, verbose_name="Category Name")
+    objects = managers.NameManager("category")
+    name = models.CharField(max_length=100, unique=True, verbose_name="Category Name")
 
 
 class Instance(models.Model):
-    name = models.CharField(max_length=100, verbose_name="Analysis Name")
+    objects = managers.NameManager("name")
+    name = models.CharField(max_length=100, unique=True, verbose_name="Analysis Name")
 
 
 class InstanceStatus(models.Model):
@@ -16,7 +18,8 @@ class InstanceStatus(models.Model):
     objects = managers.InstanceStatusManager()
     time = models.DateTimeField("Time of the status")
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
-    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    # the instance is the first column of the unique constraint, so it needs no own index
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE, db_index=False)
     STATUS_CHOICES = [
         (-2, "technical issue"),  # a technical issue within Happyface ocurred
         (-1, "info"),  # e.g. it doesn't make sense to provide an status
@@ -29,3 +32,98 @@ class InstanceStatus(models.Model):
         (-1, 'info'), (0, 'ok'), (1, 'warning'), (2, 'critical')",
         choices=STATUS_CHOICES,
     )
+
+    class Meta:
+        constraints = [
+            # Matches the key of InstanceStatusManager.update_or_create and serves as index
+            # for the status queries, which filter by instance, category and a time range
+            # and order by time.
+            models.UniqueConstraint(
+                fields=["instance", "category", "time"],
+                name="unique_instance_category_time",
+            ),
+        ]
+
+
+class InstanceStatusRollup(models.Model):
+    """:class:`~models.Model` to save the worst status of an instance per hour or day.
+    The ``compactStatuses`` command rolls the old instance statuses up into it."""
+
+    HOUR = "hour"
+    DAY = "day"
+
+    objects = managers.InstanceStatusRollupManager()
+    time = models.DateTimeField("Start of the hour or day")
+    resolution = models.CharField(max_length=4, choices=[(HOUR, "hour"), (DAY, "day")])
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE, db_index=False)
+    status = models.SmallIntegerField(
+        "worst status of the instance in the hour or day",
+        choices=InstanceStatus.STATUS_CHOICES,
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instance", "category", "time", "resolution"],
+                name="unique_rollup_instance_category_time",
+            ),
+        ]
+
+
+class InstanceStatusSnapshot(models.Model):
+    """:class:`~models.Model` with the latest status of each instance. It is updated when
+    the statuses are saved, so the current statuses can be read without searching the
+    status history."""
+
+    objects = managers.InstanceStatusSnapshotManager()
+    time = models.DateTimeField("Time of the latest status")
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE, db_index=False)
+    status = models.SmallIntegerField(
+        "latest status of the instance", choices=InstanceStatus.STATUS_CHOICES
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instance", "category"],
+                name="unique_snapshot_instance_category",
+            ),
+        ]
+
+
+class Metric(models.Model):
+    """:class:`~models.Model` with the totals of the measurements of a process (see
+    :mod:`Happyface4.metrics`) per phase, analysis and instance."""
+
+    objects = managers.MetricManager()
+    process = models.CharField("host and process id", max_length=100)
+    phase = models.CharField(max_length=50)
+    analysis = models.CharField(max_length=100)
+    instance = models.CharField(max_length=100)
+    count = models.BigIntegerField("number of runs")
+    errors = models.BigIntegerField("number of failed runs")
+    seconds_total = models.FloatField("total duration of the runs")
+    seconds_max = models.FloatField("longest duration of a run")
+    payload_bytes = models.BigIntegerField("fetched or rendered bytes")
+    queries = models.BigIntegerField("number of database queries")
+    updated = models.DateTimeField("time of the last update")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["process", "phase", "analysis", "instance"],
+                name="unique_metric_process_phase_analysis_instance",
+            ),
+        ]
+
+
+class HighWaterMark(models.Model):
+    """:class:`~models.Model` with the time of the newest data point of an instance which
+    was saved, so the next fetch only needs to request newer data (see
+    :func:`~Happyface4.app_configs.AnalysisConfig.get_high_water_mark`)."""
+
+    objects = managers.HighWaterMarkManager()
+    instance = models.OneToOneField(Instance, on_delete=models.CASCADE)
+    time = models.DateTimeField("Time of the newest saved data point")
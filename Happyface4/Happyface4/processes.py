@@ -0,0 +1,80 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+logger = logging.getLogger("getData")
+
+# the pool of this process, it is started when it is used the first time
+_pool = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process pool which runs :func:`prepare_data
+    <Happyface4.app_configs.AnalysisConfig.prepare_data>` of the analyses with
+    ``prepare_data_in_process``. It has ``settings.PREPARE_PROCESSES`` processes (the
+    number of CPUs if it is 0).
+
+    :rtype: ~concurrent.futures.ProcessPoolExecutor
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            # the processes are spawned instead of forked, because the forked processes
+            # would inherit the threads and database connections of getData
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PREPARE_PROCESSES or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_process,
+            )
+        return _pool
+
+
+def shutdown():
+    """Stops the processes of the pool, if it was started."""
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+
+def prepare_in_process(label, data, instance):
+    """
+    Runs ``prepare_data`` of the analysis in the process pool and waits for the result.
+
+    :param label: The label of the app config of the analysis.
+    :type label: str
+    :returns: The data returned by ``prepare_data``.
+    """
+    global _pool
+    pool = get_pool()
+    try:
+        return pool.submit(_prepare_data, label, data, instance).result()
+    except BrokenProcessPool:
+        # a process died, e.g. because it ran out of memory, so the pool is started again
+        # for the next instances
+        logger.error(f"The process pool broke while preparing {instance['name']}.")
+        with _lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+
+def _init_process():
+    # loads the settings and apps in the new process
+    import django
+
+    django.setup()
+
+
+def _prepare_data(label, data, instance):
+    from django.apps import apps
+
+    return apps.get_app_config(label).prepare_data(data, instance)
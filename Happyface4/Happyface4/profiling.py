@@ -0,0 +1,166 @@
+import contextvars
+import cProfile
+import os
+import re
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+# the profile of the running request and its innermost phase
+_profile = contextvars.ContextVar("profile", default=None)
+_phase = contextvars.ContextVar("phase", default=None)
+
+
+class Profile(object):
+    """
+    Timings and SQL queries of the phases of a profiled request. The phases can run in
+    parallel threads (e.g. the builddiv calls), then their timings add up to more than
+    the duration of the request.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.query_counts = defaultdict(int)
+        self.query_durations = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add_duration(self, name, seconds):
+        with self._lock:
+            self.durations[name] += seconds
+
+    def add_query(self, name, seconds):
+        with self._lock:
+            self.query_counts[name] += 1
+            self.query_durations[name] += seconds
+
+    def server_timing(self):
+        """Returns the value of the ``Server-Timing`` header with the durations of the
+        phases and their SQL queries in ms."""
+        metrics = [
+            f"{_token(name)};dur={seconds * 1000:.1f}"
+            for name, seconds in self.durations.items()
+        ]
+        metrics += [
+            f'sql.{_token(name)};dur={self.query_durations[name] * 1000:.1f};desc="{count} queries"'
+            for name, count in self.query_counts.items()
+        ]
+        return ", ".join(metrics)
+
+
+class _Phase(object):
+    # counts the queries of the thread while it is the innermost phase
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __call__(self, execute, sql, params, many, context):
+        if _phase.get() is not self:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.profile.add_query(self.name, time.perf_counter() - start)
+
+
+@contextmanager
+def phase(name):
+    """
+    Measures the duration and SQL queries of the block as a phase of the profiled
+    request. Does nothing if the request isn't profiled.
+
+    .. code-block:: python
+
+        with profiling.phase("template"):
+            ...
+
+    :param name: The name of the phase, e.g. ``"builddiv.<analysis name>"``.
+    :type name: str
+    """
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    current = _Phase(profile, name)
+    token = _phase.set(current)
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(current):
+            yield
+    finally:
+        profile.add_duration(name, time.perf_counter() - start)
+        _phase.reset(token)
+
+
+def is_active():
+    """Whether the running request is profiled."""
+    return _profile.get() is not None
+
+
+def is_requested(request):
+    """
+    Whether the request asks to be profiled with the ``X-Profile`` header or the
+    ``profile`` query parameter. The value has to be ``settings.PROFILING_TOKEN``, if it
+    isn't set, profiling is only possible in debug mode.
+    """
+    token = request.headers.get("X-Profile") or request.GET.get("profile")
+    if not token:
+        return False
+    if settings.PROFILING_TOKEN:
+        return secrets.compare_digest(token, settings.PROFILING_TOKEN)
+    return settings.DEBUG
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles the requests which ask for it (see :func:`is_requested`). The durations and
+    SQL queries of the phases of the views are added as ``Server-Timing`` header, which
+    is shown by the developer tools of the browsers. If ``settings.PROFILING_DIR`` is
+    set, a cProfile dump of the request thread is saved there, e.g. to view it with
+    ``python -m pstats <file>`` or snakeviz.
+
+    Streamed responses are finished after the middleware, so their profiles don't cover
+    the streamed content. Therefore profiled category pages aren't streamed, even if
+    ``settings.STREAM_PAGES`` is set.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_requested(request):
+            return self.get_response(request)
+
+        profile = Profile()
+        token = _profile.set(profile)
+        profiler = cProfile.Profile() if settings.PROFILING_DIR else None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            with phase("total"):
+                response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            _profile.reset(token)
+        response["Server-Timing"] = profile.server_timing()
+        if profiler is not None:
+            os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+            profiler.dump_stats(
+                os.path.join(
+                    settings.PROFILING_DIR,
+                    f"{timezone.now():%Y%m%d-%H%M%S-%f}{_token(request.path)}.prof",
+                )
+            )
+        return response
+
+
+def _token(name):
+    # the names in the Server-Timing header have to be tokens
+    return re.sub(r"[^\w.\-]", "_", name)
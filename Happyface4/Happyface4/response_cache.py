@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger("getData")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns the response cache of the sources in ``settings.RESPONSE_CACHE_DIR`` or
+    ``None`` if it isn't set.
+
+    :rtype: ResponseCache
+    """
+    global _cache
+    directory = settings.RESPONSE_CACHE_DIR
+    if not directory:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.directory != directory:
+            try:
+                _cache = ResponseCache(
+                    directory, settings.RESPONSE_CACHE_MAX_SIZE * 1024 * 1024
+                )
+            except OSError:
+                # the requests are sent without the cache
+                logger.exception(f"Couldn't create the response cache in {directory}.")
+                return None
+        return _cache
+
+
+class ResponseCache(object):
+    """
+    On disk cache of the responses of the sources, which is used by the helpers to send
+    conditional requests (with ``If-None-Match`` and ``If-Modified-Since``) and to
+    detect unchanged responses by their content hash. The least recently used responses
+    are deleted if the cache is larger than ``max_size``. Errors of the cache are logged
+    and otherwise ignored, so they never fail a fetch. Several processes can share the
+    directory. Each response is a single file with a line of JSON meta data followed by
+    the body, so the body always belongs to its meta data.
+
+    Additionally it stores a fingerprint of the responses an instance got and the status
+    it saved, so instances of analyses with ``skip_unchanged`` can skip
+    ``save_data_to_db`` if their responses didn't change.
+
+    :param directory: The directory of the cache.
+    :type directory: str
+    :param max_size: Maximum size of the cached responses in bytes.
+    :type max_size: int
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # the size of the cached responses, counted when the cache is used first
+        self._size = None
+        os.makedirs(os.path.join(directory, "responses"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "instances"), exist_ok=True)
+
+    def get(self, key):
+        """
+        Returns the meta data (``etag``, ``last_modified``, ``content_hash`` and
+        ``headers``) of the cached response of the request or ``None``.
+
+        :param key: The request, e.g. ``(method, url, headers, body)``.
+        :type key: tuple
+        :rtype: dict
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as response_file:
+                meta = json.loads(response_file.readline())
+            # marks the response as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def read(self, key, content_hash):
+        """Returns the cached body of the request or ``None`` if it isn't cached or was
+        replaced by a response with another hash since the meta data was read."""
+        try:
+            with open(self._path(key), "rb") as response_file:
+                meta = json.loads(response_file.readline())
+                if meta["content_hash"] != content_hash:
+                    return None
+                return response_file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, headers, body, content_hash):
+        """
+        Saves the response of the request. Responses without ``ETag`` and
+        ``Last-Modified`` header aren't saved, because they can't be revalidated.
+
+        :param headers: The response headers.
+        :type headers: dict
+        :param body: The response body.
+        :type body: bytes
+        :param content_hash: The sha256 hash of the body.
+        :type content_hash: str
+        """
+        meta = {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "content_hash": content_hash,
+            "headers": dict(headers),
+        }
+        if not meta["etag"] and not meta["last_modified"]:
+            return
+        # the JSON of the meta data has no line breaks
+        data = json.dumps(meta).encode() + b"\n" + body
+        if len(data) > self.max_size:
+            return
+        path = self._path(key)
+        with self._lock:
+            try:
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                _write(path, data)
+                if self._size is not None:
+                    self._size += len(data) - old_size
+                self._evict()
+            except OSError:
+                logger.exception(f"Couldn't cache the response in {path}.")
+
+    def get_instance(self, name):
+        """Returns the ``fingerprint`` and ``status`` saved for the instance or ``None``."""
+        try:
+            with open(self._instance_path(name)) as instance_file:
+                return json.load(instance_file)
+        except (OSError, ValueError):
+            return None
+
+    def put_instance(self, name, fingerprint, status):
+        """Saves the fingerprint of the responses of the instance and its status."""
+        path = self._instance_path(name)
+        try:
+            _write(
+                path,
+                json.dumps({"fingerprint": fingerprint, "status": status}).encode(),
+            )
+        except OSError:
+            logger.exception(f"Couldn't cache the fingerprint of {name} in {path}.")
+
+    def _evict(self):
+        # deletes the least recently used responses until the cache is small enough
+        responses = os.path.join(self.directory, "responses")
+        if self._size is not None and self._size <= self.max_size:
+            return
+        files = []
+        for entry in os.scandir(responses):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # deleted by another process meanwhile
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        self._size = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, path in files:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
+            logger.debug(f"Deleted the cached response {path}.")
+
+    def _path(self, key):
+        # the suffix keeps files of the former format with separate meta data from
+        # being read, they are deleted by the eviction
+        name = hashlib.sha256(repr(key).encode()).hexdigest() + ".response"
+        return os.path.join(self.directory, "responses", name)
+
+    def _instance_path(self, name):
+        return os.path.join(
+            self.directory, "instances", hashlib.sha256(name.encode()).hexdigest()
+        )
+
+
+def _write(path, data):
+    # writes a temporary file with a unique name first, so other threads and processes
+    # never read half a file and don't write to the same temporary file
+    directory, name = os.path.split(path)
+    temporary_file = tempfile.NamedTemporaryFile(
+        dir=directory, prefix=name + ".", suffix=".tmp", delete=False
+    )
+    try:
+        with temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_file.name, path)
+    except BaseException:
+        try:
+            os.remove(temporary_file.name)
+        except OSError:
+            pass
+        raise
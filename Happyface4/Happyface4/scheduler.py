@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import logging
+import math
+import random
+import zlib
+
+from django.conf import settings
+
+logger = logging.getLogger("getData")
+
+
+class Job(object):
+    """
+    A job of the :class:`Scheduler`, which runs every ``interval`` seconds. Its slots are
+    ``phase`` seconds after the multiples of the interval (counted from the epoch), each
+    run starts up to ``jitter`` seconds after its slot.
+
+    :param name: The name of the job, used for logging.
+    :type name: str
+    :param interval: Seconds between the slots of the job.
+    :type interval: float
+    :param phase: Offset of the slots in seconds.
+    :type phase: float
+    :param jitter: Maximum random delay of the runs in seconds.
+    :type jitter: float
+    :param function: Called by the worker when the job is due. Fetch jobs don't have one,
+                     they are run by the :class:`~Happyface4.fetcher.Fetcher`.
+    :type function: callable
+    :param group: Jobs of the same group with the same slot get the same random delay,
+                  so they are due at the same time.
+    :type group: str
+    """
+
+    def __init__(
+        self, name, interval, phase=0.0, jitter=0.0, function=None, group=None
+    ):
+        self.name = name
+        self.interval = interval
+        self.phase = phase % interval
+        self.jitter = jitter
+        self.function = function
+        self.group = group
+        self.running = False
+        """Set by the scheduler when the job is due and reset by the worker when it
+        finished, a job which is still running skips its next slots."""
+
+    def next_slot(self, time):
+        """Returns the first slot of the job after ``time``."""
+        return (
+            math.floor((time - self.phase) / self.interval) + 1
+        ) * self.interval + self.phase
+
+
+class FetchJob(Job):
+    """
+    Job which fetches the data of an analysis instance every ``get_data_every`` pull
+    intervals. The phase of the instance is derived from its name, so the instances are
+    spread over ``phase_spread`` (a fraction) of their interval and keep their slots
+    after a restart. If ``settings.FETCH_COALESCE`` is set, the phase is derived from the
+    source of the instance instead, so the instances of the same source are fetched in
+    the same cycle and their identical requests are sent once.
+
+    :param analysis: The analysis of the instance.
+    :type analysis: AnalysisConfig
+    :param instance: The instance dict.
+    :type instance: dict
+    """
+
+    def __init__(self, analysis, instance, phase_spread=None, jitter=None):
+        interval = settings.PULL_INTERVAL.total_seconds() * instance.get(
+            "get_data_every", 1
+        )
+        if phase_spread is None:
+            phase_spread = settings.FETCH_PHASE_SPREAD
+        # the spread is at most one pull interval, otherwise instances which are fetched
+        # every few pull intervals would miss the status time range of the website
+        group = (source_group(instance) or None) if settings.FETCH_COALESCE else None
+        phase = (
+            zlib.crc32((group or instance["name"]).encode())
+            / 2**32
+            * phase_spread
+            * settings.PULL_INTERVAL.total_seconds()
+        )
+        super().__init__(
+            name=f"{analysis.name}/{instance['name']}",
+            interval=interval,
+            phase=phase,
+            jitter=settings.FETCH_JITTER if jitter is None else jitter,
+            group=group,
+        )
+        self.analysis = analysis
+        self.instance = instance
+
+
+def source_group(instance):
+    """Returns the group of the fetch job of the instance, its source."""
+    source = instance.get("source", "")
+    if type(source) == list:
+        source = " ".join(source)
+    return source
+
+
+class Scheduler(object):
+    """
+    Priority queue of the next runs of jobs. The worker asks for the jobs due with
+    :func:`pop_due` and sleeps until :func:`next_time`.
+
+    :param catch_up: What happens if a job missed slots, e.g. because the worker was busy
+                     or not running. With ``"once"`` it runs once as soon as possible,
+                     with ``"skip"`` it waits for its next slot.
+    :type catch_up: str
+    """
+
+    CATCH_UP_POLICIES = ("once", "skip")
+
+    def __init__(self, catch_up=None):
+        self.catch_up = catch_up or settings.FETCH_CATCH_UP
+        if self.catch_up not in self.CATCH_UP_POLICIES:
+            raise ValueError(
+                f"Unknown catch up policy {self.catch_up}, use one of {self.CATCH_UP_POLICIES}."
+            )
+        self._queue = []
+        # tie breaker of jobs with the same run time, jobs aren't comparable
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, job, now):
+        """Schedules the job for its first slot after ``now``."""
+        self._push(job, job.next_slot(now))
+
+    def next_time(self):
+        """Returns the time of the next run or ``None`` if there are no jobs."""
+        return self._queue[0][0] if self._queue else None
+
+    def pop_due(self, now):
+        """
+        Returns the jobs whose run is due at ``now`` and schedules their next slots.
+
+        :param now: The current time as timestamp.
+        :type now: float
+        :returns: The due jobs, they are marked as running.
+        :rtype: list of Job
+        """
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, _, slot, job = heapq.heappop(self._queue)
+            next_slot = slot + job.interval
+            run = True
+            if next_slot <= now:
+                # the job missed at least one slot, the missed slots are dropped
+                run = self.catch_up == "once"
+                logger.warning(
+                    f"{job.name} missed its slots since {slot:.0f}, {'run once now' if run else 'skipped'}."
+                )
+                next_slot = job.next_slot(now)
+            if run and job.running:
+                logger.warning(f"{job.name} is still running, the run is skipped.")
+                run = False
+            if run:
+                job.running = True
+                due.append(job)
+            self._push(job, next_slot)
+        return due
+
+    def _push(self, job, slot):
+        # the delay of a group is random per slot, but the same for all its jobs
+        rng = random if job.group is None else random.Random(f"{job.group}:{slot}")
+        run_time = slot + rng.uniform(0, job.jitter)
+        heapq.heappush(self._queue, (run_time, next(self._counter), slot, job))
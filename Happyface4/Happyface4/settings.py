@@ -71,6 +71,7 @@ with open(ANALYSES_LIST, "r") as a_list_file:
     INSTALLED_APPS += yaml.safe_load(a_list_file) or []
 
 MIDDLEWARE = [
+    "Happyface4.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -177,10 +178,117 @@ USE_TZ = True
 PULL_INTERVAL = timedelta(
     minutes=int(os.getenv("GETDATA_INTERVALL", "15"))
 )  # time interval in which new data should be fetched.
-GETDATA_SLEEP = 60  # time span (in seconds) getDataRoutine sleeps until it checks if it is time to get new data (set with PULL_INTERVAL).
 OVERVIEW_RANGE = (
     PULL_INTERVAL * 4 * 24
 )  # Time range in which the instance status should be displayed on the start page
+STATUS_RETENTION = timedelta(
+    days=int(os.getenv("STATUS_RETENTION_DAYS", "30"))
+)  # time span in which the instance statuses are kept in full resolution, older ones are rolled up into hourly statuses by the compactStatuses command.
+STATUS_HOURLY_RETENTION = timedelta(
+    days=int(os.getenv("STATUS_HOURLY_RETENTION_DAYS", "365"))
+)  # time span in which the hourly statuses are kept, older ones are rolled up into daily statuses.
+DATA_RETENTION = (
+    timedelta(days=int(os.getenv("DATA_RETENTION_DAYS")))
+    if os.getenv("DATA_RETENTION_DAYS")
+    else None
+)  # time span in which the data of the analyses is kept by the compactStatuses command (None keeps all data).
+COMPACT_STATUSES = (
+    os.getenv("COMPACT_STATUSES") == "True"
+)  # if True, getDataRoutine runs the compactStatuses command once a day.
+HTTP_POOL_SIZE = int(
+    os.getenv("HTTP_POOL_SIZE", "10")
+)  # number of kept alive connections per host of the HTTP helpers (Happyface4.helpers).
+HTTP_CONNECT_TIMEOUT = int(
+    os.getenv("HTTP_CONNECT_TIMEOUT", "10")
+)  # seconds until the HTTP helpers give up connecting to a host.
+HTTP_READ_TIMEOUT = int(
+    os.getenv("HTTP_READ_TIMEOUT", "120")
+)  # seconds the HTTP helpers wait for data from a host.
+HTTP_RETRIES = int(
+    os.getenv("HTTP_RETRIES", "3")
+)  # how often the HTTP helpers retry failed requests.
+HTTP_BACKOFF = float(
+    os.getenv("HTTP_BACKOFF", "0.5")
+)  # backoff factor in seconds between the retries, doubled after each retry.
+FETCH_CONCURRENCY = int(
+    os.getenv("FETCH_CONCURRENCY", "32")
+)  # maximum number of instances whose data is fetched at the same time.
+FETCH_HOST_CONCURRENCY = int(
+    os.getenv("FETCH_HOST_CONCURRENCY", "8")
+)  # maximum number of instances whose data is fetched at the same time from the same host.
+FETCH_TIMEOUT = int(
+    os.getenv("FETCH_TIMEOUT", str(PULL_INTERVAL.seconds))
+)  # seconds after which fetching the data of an instance is given up (can be set per instance with the "timeout" key).
+FETCH_PHASE_SPREAD = float(
+    os.getenv("FETCH_PHASE_SPREAD", "0.5")
+)  # fraction of the pull interval over which getDataRoutine spreads the fetches of the instances (0 fetches all at the start of the interval). With FETCH_COALESCE the instances of the same source share their slot.
+FETCH_JITTER = float(
+    os.getenv("FETCH_JITTER", "10")
+)  # maximum random delay in seconds of each fetch of getDataRoutine, should stay below a minute.
+FETCH_COALESCE = (
+    os.getenv("FETCH_COALESCE", "True") == "True"
+)  # if True, identical requests of the helpers of several instances in the same fetch cycle, which are sent at the same time, are sent only once.
+RESPONSE_CACHE_DIR = os.getenv(
+    "RESPONSE_CACHE_DIR"
+)  # directory in which the responses of the sources are cached for conditional requests (None disables the cache).
+RESPONSE_CACHE_MAX_SIZE = int(
+    os.getenv("RESPONSE_CACHE_MAX_SIZE", "500")
+)  # maximum size of the response cache in MB, the least recently used responses are deleted.
+PREPARE_PROCESSES = int(
+    os.getenv("PREPARE_PROCESSES", "0")
+)  # number of processes which run prepare_data of the analyses with prepare_data_in_process (0 uses one per CPU).
+FETCH_CATCH_UP = os.getenv(
+    "FETCH_CATCH_UP", "once"
+)  # what getDataRoutine does if an instance missed its slots, "once" fetches it once as soon as possible, "skip" waits for the next slot.
+STATUS_FLUSH_INTERVAL = float(
+    os.getenv("STATUS_FLUSH_INTERVAL", "10")
+)  # seconds after which getDataRoutine saves the statuses of the instances fetched meanwhile together.
+METRICS_ENABLED = (
+    os.getenv("METRICS_ENABLED", "True") == "True"
+)  # if True, the durations, payload sizes, errors and queries of getData and builddiv are measured and exported at /metrics.
+METRICS_FLUSH_INTERVAL = int(
+    os.getenv("METRICS_FLUSH_INTERVAL", "60")
+)  # seconds between the saves of the metrics of a process in the database.
+METRICS_TOKEN = os.getenv(
+    "METRICS_TOKEN"
+)  # /metrics is only exported to requests with this token as bearer token in the Authorization header or in the token query parameter, without a token only in debug mode.
+METRICS_TTL = int(
+    os.getenv("METRICS_TTL", "86400")
+)  # seconds after which the metrics of a process, which didn't save them anymore (e.g. because it was restarted), are deleted.
+PROFILING_TOKEN = os.getenv(
+    "PROFILING_TOKEN"
+)  # requests with this token in the X-Profile header or the profile query parameter get Server-Timing headers, without a token only in debug mode.
+PROFILING_DIR = os.getenv(
+    "PROFILING_DIR"
+)  # directory in which cProfile dumps of the profiled requests are saved (None saves no dumps).
+RENDER_THREADS = int(
+    os.getenv("RENDER_THREADS", "1")
+)  # number of threads which build the analysis divs of a category in parallel (1 renders them one after another).
+LAZY_PANELS = (
+    os.getenv("LAZY_PANELS", "False") == "True"
+)  # if True, the category page is sent with placeholders and the browser loads the analysis divs in parallel.
+STREAM_PAGES = (
+    os.getenv("STREAM_PAGES", "False") == "True"
+)  # if True, the category page is streamed, the analysis divs are sent one after another as soon as they are built (ignored with LAZY_PANELS and for profiled requests).
+
+# Caches, the "divs" cache stores the rendered analysis divs. The backend can be changed,
+# e.g. to "django.core.cache.backends.filebased.FileBasedCache" with a directory as
+# location or to "django.core.cache.backends.dummy.DummyCache" to disable the cache.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "divs": {
+        "BACKEND": os.getenv(
+            "DIV_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("DIV_CACHE_LOCATION", "happyface_divs"),
+        "TIMEOUT": PULL_INTERVAL.seconds,  # the divs of the current time are cached for one pull interval
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.getenv("DIV_CACHE_MAX_ENTRIES", "1000")),
+        },
+    },
+}
 
 LEGALS_URL = os.getenv("LEGALS_URL")  # URL of the legal notice
 COMMIT_SHA = os.getenv("COMMIT_SHA")  # the commit hash of this version
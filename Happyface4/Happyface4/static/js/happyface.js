@@ -12,4 +12,49 @@ function collapse(id) {
  */
  const tooltipTriggerList = document.querySelectorAll('[data-bs-toggle="tooltip"]')
  const tooltipList = [...tooltipTriggerList].map(tooltipTriggerEl => new bootstrap.Tooltip(tooltipTriggerEl))
- 
\ No newline at end of file
+ 
+
+/**
+ * Loads the analysis divs of the placeholders with the data-panel-url attribute (used if LAZY_PANELS is set).
+ * All divs are requested at once and each replaces its placeholder as soon as it arrived, so slow analyses don't hold up the others.
+ */
+function loadPanels() {
+    document.querySelectorAll('[data-panel-url]').forEach(placeholder => {
+        fetch(placeholder.dataset.panelUrl)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(response.status + ' ' + response.statusText);
+                }
+                return response.text();
+            })
+            .then(html => {
+                const template = document.createElement('template');
+                template.innerHTML = html.trim();
+                // scripts inserted as HTML aren't executed, so they are replaced by new script elements
+                template.content.querySelectorAll('script').forEach(oldScript => {
+                    const script = document.createElement('script');
+                    [...oldScript.attributes].forEach(attribute => script.setAttribute(attribute.name, attribute.value));
+                    script.text = oldScript.text;
+                    // external scripts are executed in order like in the category page
+                    script.async = false;
+                    oldScript.replaceWith(script);
+                });
+                const panels = [...template.content.children];
+                placeholder.replaceWith(template.content);
+                panels.forEach(panel => {
+                    panel.querySelectorAll('[data-bs-toggle="tooltip"]').forEach(tooltipTriggerEl => new bootstrap.Tooltip(tooltipTriggerEl));
+                    // jump to the instance linked in the navigation bar once it is loaded
+                    if (panel.id && window.location.hash === '#' + panel.id) {
+                        panel.scrollIntoView();
+                    }
+                });
+            })
+            .catch(error => {
+                placeholder.querySelector('.spinner-border')?.remove();
+                placeholder.insertAdjacentHTML('beforeend', '<div class="alert alert-danger mt-2" role="alert">The analysis could not be loaded.</div>');
+                console.error(placeholder.dataset.panelUrl, error);
+            });
+    });
+}
+
+loadPanels();
@@ -0,0 +1,251 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from Happyface4 import helpers
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticsearchStub(BaseHTTPRequestHandler):
+    """Answers the point in time, search_after and scroll requests of
+    :func:`~Happyface4.helpers.scroll_elasticsearch` with the documents 0 to
+    ``server.documents - 1``. The search of the slice ``server.failing_slice`` fails, the
+    slice ``server.empty_slice`` finds no documents after a second."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or "{}")
+        path = self.path.split("?")[0]
+        if path.endswith("/_pit"):
+            self.reply({"id": "pit"})
+        elif path == "/_search/scroll":
+            self.reply(self.page(*self.server.scrolls[body["scroll_id"]]))
+        elif path.endswith("/_search"):
+            slice_id = body.get("slice", {}).get("id", 0)
+            if slice_id == self.server.failing_slice:
+                self.reply({"error": "failed"}, status=400)
+                return
+            if slice_id == self.server.empty_slice:
+                time.sleep(1)
+                self.reply({"hits": {"hits": []}})
+                return
+            documents = [
+                i
+                for i in range(self.server.documents)
+                if i % body.get("slice", {}).get("max", 1) == slice_id
+            ]
+            if "pit" in body:
+                after = body.get("search_after", [-1])[0]
+                documents = [i for i in documents if i > after]
+                self.reply(self.page(documents, body["size"]))
+            else:
+                scroll_id = f"scroll{slice_id}"
+                self.server.scrolls[scroll_id] = (documents, body["size"])
+                self.reply(
+                    dict(self.page(documents, body["size"]), _scroll_id=scroll_id)
+                )
+        else:
+            self.reply({}, status=404)
+
+    def do_DELETE(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.deleted.append(self.path)
+        self.reply({"succeeded": True})
+
+    def page(self, documents, size):
+        # removes the returned documents from the list, so a scroll continues after them
+        hits = [{"_id": str(i), "sort": [i]} for i in documents[:size]]
+        del documents[:size]
+        self.server.requests += 1
+        return {"hits": {"hits": hits}}
+
+    def reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ScrollElasticsearchTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ElasticsearchStub)
+        self.server.documents = 250
+        self.server.failing_slice = None
+        self.server.empty_slice = None
+        self.server.scrolls = {}
+        self.server.deleted = []
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def scroll(self, **kwargs):
+        return helpers.scroll_elasticsearch(
+            self.base_url, "index", {"query": {"match_all": {}}}, [], logger, **kwargs
+        )
+
+    def ids(self, hits):
+        return sorted(int(hit["_id"]) for hit in hits)
+
+    def in_thread(self, function):
+        # runs the function in a thread, so a deadlock fails the test instead of hanging
+        thread = threading.Thread(target=function, daemon=True)
+        thread.start()
+        thread.join(timeout=15)
+        self.assertFalse(thread.is_alive(), "scroll_elasticsearch did not return")
+
+    def test_search_after(self):
+        self.assertEqual(
+            self.ids(self.scroll(page_size=100)), list(range(self.server.documents))
+        )
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.deleted, ["/_pit"])
+
+    def test_scroll(self):
+        self.assertEqual(
+            self.ids(self.scroll(page_size=100, use_scroll=True)),
+            list(range(self.server.documents)),
+        )
+        self.assertEqual(self.server.deleted, ["/_search/scroll"])
+
+    def test_slices(self):
+        for use_scroll in (False, True):
+            with self.subTest(use_scroll=use_scroll):
+                self.assertEqual(
+                    self.ids(
+                        self.scroll(page_size=10, slices=4, use_scroll=use_scroll)
+                    ),
+                    list(range(self.server.documents)),
+                )
+
+    def test_consumer_stops_early(self):
+        # the other slices fill the queue, before the empty slice marks its end
+        self.server.empty_slice = 0
+
+        def stop_early():
+            hits = self.scroll(page_size=1, slices=3)
+            next(hits)
+            time.sleep(2)
+            hits.close()
+
+        self.in_thread(stop_early)
+        self.assertEqual(self.server.deleted, ["/_pit"])
+
+    def test_failing_slice(self):
+        self.server.failing_slice = 1
+
+        def fail():
+            with self.assertRaises(Exception):
+                list(self.scroll(page_size=1, slices=3))
+
+        with self.assertLogs(logger, "ERROR"):
+            self.in_thread(fail)
+        self.assertEqual(self.server.deleted, ["/_pit"])
+
+
+class InfluxqlSinceTests(SimpleTestCase):
+    since = datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+    condition = "time > 1700000000000ms"
+
+    def assertSince(self, query, expected):
+        self.assertEqual(
+            helpers.influxql_since(query, self.since),
+            expected.format(condition=self.condition),
+        )
+
+    def test_without_where(self):
+        self.assertSince(
+            'SELECT mean("value") FROM "limits_usage" GROUP BY time(1h)',
+            'SELECT mean("value") FROM "limits_usage" WHERE {condition} GROUP BY time(1h)',
+        )
+        self.assertSince(
+            "SELECT value FROM cpu", "SELECT value FROM cpu WHERE {condition}"
+        )
+
+    def test_with_where(self):
+        self.assertSince(
+            "SELECT value FROM cpu WHERE host = 'a' OR host = 'b' LIMIT 10",
+            "SELECT value FROM cpu WHERE {condition} AND (host = 'a' OR host = 'b') LIMIT 10",
+        )
+
+    def test_keywords_in_identifiers(self):
+        self.assertSince(
+            'SELECT "offset", "limit" FROM "where" GROUP BY "group"',
+            'SELECT "offset", "limit" FROM "where" WHERE {condition} GROUP BY "group"',
+        )
+        self.assertSince(
+            "SELECT offset_ms FROM limits tz('Europe/Berlin')",
+            "SELECT offset_ms FROM limits WHERE {condition} tz('Europe/Berlin')",
+        )
+
+    def test_literals(self):
+        self.assertSince(
+            "SELECT value FROM cpu WHERE host = 'a;b' AND msg = 'GROUP BY x'; SELECT value FROM mem",
+            "SELECT value FROM cpu WHERE {condition} AND (host = 'a;b' AND msg = 'GROUP BY x');"
+            " SELECT value FROM mem WHERE {condition}",
+        )
+        self.assertSince(
+            "SELECT value / 2 FROM /cpu;.*/ WHERE host =~ /a;b|LIMIT/",
+            "SELECT value / 2 FROM /cpu;.*/ WHERE {condition} AND (host =~ /a;b|LIMIT/)",
+        )
+
+    def test_unchanged(self):
+        for query in (
+            "SHOW MEASUREMENTS",
+            "SELECT max(value) FROM (SELECT value FROM cpu) GROUP BY time(1h)",
+        ):
+            self.assertEqual(helpers.influxql_since(query, self.since), query)
+        self.assertEqual(
+            helpers.influxql_since("SELECT a FROM b", None), "SELECT a FROM b"
+        )
+
+
+class GrafanaBatchTests(SimpleTestCase):
+    def test_semicolons_in_literals(self):
+        queries = [
+            "SELECT value FROM cpu WHERE host = 'a;b'; SELECT value FROM /mem;.*/",
+            'SELECT "x;y" FROM disk;',
+        ]
+        response = {
+            "results": [
+                {"statement_id": 0, "series": ["cpu"]},
+                {"statement_id": 1, "series": ["mem"]},
+                {"statement_id": 2, "series": ["disk"]},
+            ]
+        }
+        with mock.patch.object(
+            helpers, "get_data_from_grafana", return_value=response
+        ) as get_data:
+            results = helpers.get_data_from_grafana_batch("url", "db", queries)
+        self.assertEqual(
+            get_data.call_args.args[2],
+            "SELECT value FROM cpu WHERE host = 'a;b';\n"
+            " SELECT value FROM /mem;.*/;\n"
+            'SELECT "x;y" FROM disk',
+        )
+        self.assertEqual(
+            results,
+            [
+                {
+                    "results": [
+                        {"statement_id": 0, "series": ["cpu"]},
+                        {"statement_id": 1, "series": ["mem"]},
+                    ]
+                },
+                {"results": [{"statement_id": 0, "series": ["disk"]}]},
+            ],
+        )
@@ -26,6 +26,8 @@ urlpatterns = [
     # path("admin/", admin.site.urls),
     path("", views.home, name="home"),
     path("categories/<str:category>/", views.index, name="index"),
+    path("categories/<str:category>/<str:instance>/", views.panel, name="panel"),
+    path("metrics", views.metrics, name="metrics"),
 ]
 
 for analysisConfig in utilities.get_Analyses_from_apps(apps):
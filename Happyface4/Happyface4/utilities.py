@@ -1,10 +1,18 @@
-import copy
+import bisect
+import contextvars
 import datetime
 import logging
+import queue
+import threading
+from concurrent.futures import Future
 
 from django.conf import settings
+from django.db import connections
+from django.template.loader import render_to_string
+from django.urls import reverse
 from django.utils import timezone
 
+from . import profiling
 from .forms import DateTimeForm
 from .status import STATUS
 
@@ -47,41 +55,85 @@ class DummyInstanceStatus(object):
         return self
 
 
+class InstanceStatusList(list):
+    """
+    List of instance statuses ordered by time, which imitates the methods of a QuerySet
+    that are used on the instance statuses. Returned by the bulk status loading.
+    """
+
+    def latest(self, _):
+        # The statuses are ordered by time, so the last one is the latest.
+        return self[-1]
+
+    def last(self):
+        return self[-1]
+
+    def exists(self):
+        return bool(self)
+
+
 class CategoryNav(object):
     def __init__(self, name, instance):
         self.name = name
         self.instances = [instance]
+        self._statuses_list = None
 
     def latest_status(self):
         return max([i.latest_status() for i in self.instances])
 
     def statuses_list(self):
-        cat_status_list = []
-        # find instance with most status entries
-        most_status_entries = copy.deepcopy(
-            max([inst.status for inst in self.instances], key=len)
-        )
-
-        # find the worst status at each time
-        for timepoint in most_status_entries:
-            instance_status_list = []
-            for inst in self.instances:
-                if type(inst.status) is not DummyInstanceStatus:
-                    timediffs = [
-                        abs(timepoint.time - status.time) for status in inst.status
-                    ]
-                    nearest_status_index = timediffs.index(min(timediffs))
-                    nearest_status = inst.status[nearest_status_index]
-                    if type(nearest_status) is int:
-                        instance_status_list.append(nearest_status)
-                    else:
-                        instance_status_list.append(nearest_status.status)
-                else:
-                    instance_status_list.append(inst.status.status)
-            cat_status_list.append(
-                {"time": timepoint.time, "status": max(instance_status_list)}
-            )
-        return cat_status_list
+        # the template calls this more than once, so the result is only computed once
+        if self._statuses_list is None:
+            self._statuses_list = self._merge_statuses()
+        return self._statuses_list
+
+    def _merge_statuses(self):
+        # find instance with most status entries, its times are used as the timeline
+        most_status_entries = max([inst.status for inst in self.instances], key=len)
+        timeline = [timepoint.time for timepoint in most_status_entries]
+
+        # the worst status at each time is the maximum of the status of each instance
+        # nearest to that time
+        cat_statuses = [None] * len(timeline)
+        for inst in self.instances:
+            if type(inst.status) is DummyInstanceStatus:
+                nearest_statuses = [inst.status.status] * len(timeline)
+            else:
+                nearest_statuses = _nearest_statuses(timeline, inst.status)
+            cat_statuses = [
+                status if worst is None else max(worst, status)
+                for worst, status in zip(cat_statuses, nearest_statuses)
+            ]
+        return [
+            {"time": time, "status": status}
+            for time, status in zip(timeline, cat_statuses)
+        ]
+
+
+def _nearest_statuses(timeline, statuses):
+    """
+    Finds for each time of the timeline the status with the nearest time. If two statuses
+    are equally near the earlier one is used.
+
+    :param timeline: The times to find the nearest status for.
+    :type timeline: list of datetime.datetime
+    :param statuses: Objects with ``time`` and ``status`` attributes.
+    :type statuses: iterable
+    :returns: The status values nearest to each time of the timeline.
+    :rtype: list of int
+    """
+    statuses = sorted(statuses, key=lambda status: status.time)
+    times = [status.time for status in statuses]
+    nearest = []
+    for time in timeline:
+        index = bisect.bisect_left(times, time)
+        if index == len(times) or (
+            index > 0 and time - times[index - 1] <= times[index] - time
+        ):
+            # use the first status if several statuses have the same time
+            index = bisect.bisect_left(times, times[index - 1])
+        nearest.append(statuses[index].status)
+    return nearest
 
 
 class InstanceNav(object):
@@ -155,20 +207,35 @@ def get_apps_with_instances_in_category(app_config_list, category):
     return apps_in_category
 
 
-def render_instances(analyses_list, category, time, request):
-    divs = []
-    instance_orders = []
+def render_instances(analyses_list, category, time, request, historical=False):
     ananlyses_to_render = get_apps_with_instances_in_category(analyses_list, category)
     # catch case where the category string doesn't match the category of any analysis
     if not ananlyses_to_render:
         return []
-    for app_config, instances_list in ananlyses_to_render:
-        # the instance is a tuple where the first item is the app config and the second is a list of all
-        # instances of the app that have to be rendered
-        for instance in instances_list:
-            anaDiv = app_config.builddiv(time, instance, request)
-            divs.append(anaDiv)
-            instance_orders.append(instance.get("order", -1))
+    # the instance is a tuple where the first item is the app config and the second is a list of all
+    # instances of the app that have to be rendered
+    instances_to_render = [
+        (app_config, instance)
+        for app_config, instances_list in ananlyses_to_render
+        for instance in instances_list
+    ]
+
+    # the divs of the instances don't depend on each other, so they can be built in
+    # parallel threads (set with settings.RENDER_THREADS)
+    max_workers = min(getattr(settings, "RENDER_THREADS", 1), len(instances_to_render))
+    if max_workers > 1:
+        divs = [
+            future.result()
+            for future in _builddivs_in_threads(
+                instances_to_render, time, request, historical, max_workers
+            )
+        ]
+    else:
+        divs = [
+            _builddiv(app_config, time, instance, request, historical)
+            for app_config, instance in instances_to_render
+        ]
+    instance_orders = [instance.get("order", -1) for _, instance in instances_to_render]
 
     # show analyses with negative/unspecified ordering specifications last
     instance_orders = [len(instance_orders) if o < 0 else o for o in instance_orders]
@@ -178,13 +245,163 @@ def render_instances(analyses_list, category, time, request):
     return sorted_divs
 
 
-def get_statuses_of_instances(app_list, time, time_range):
+def get_ordered_instances_in_category(analyses_list, category):
+    """
+    Returns the ``(app_config, instance)`` tuples of the instances in the category in
+    the order in which they are displayed, instances without order come last.
+    """
+    instances = [
+        (app_config, instance)
+        for app_config, instances_list in get_apps_with_instances_in_category(
+            analyses_list, category
+        )
+        for instance in instances_list
+    ]
+    # same order as render_instances, unspecified orders last
+    last = len(instances)
+    instances.sort(
+        key=lambda item: last if item[1].get("order", -1) < 0 else item[1]["order"]
+    )
+    return instances
+
+
+def render_placeholders(analyses_list, category, request):
+    """
+    Renders placeholders instead of the divs of the instances in the category, the
+    browser loads the divs from the ``panel`` view (see ``settings.LAZY_PANELS``).
+    Returns an empty list if there is no instance in the category.
+    """
+    query = request.GET.urlencode()
+    return [
+        render_to_string(
+            "panel_placeholder.html",
+            {
+                "instance": instance,
+                "url": reverse("panel", args=[category, instance["name"]])
+                + (f"?{query}" if query else ""),
+            },
+        )
+        for _, instance in get_ordered_instances_in_category(analyses_list, category)
+    ]
+
+
+def stream_instances(instances, time, request, historical=False):
+    """
+    Builds the divs of the instances like :func:`render_instances` and yields each div as
+    soon as it and the divs before it are built (see ``settings.STREAM_PAGES``).
+
+    :param instances: The ``(app_config, instance)`` tuples in the order of the page,
+                      see :func:`get_ordered_instances_in_category`.
+    :type instances: list of tuple
+    """
+    max_workers = min(getattr(settings, "RENDER_THREADS", 1), len(instances))
+    if max_workers <= 1:
+        for app_config, instance in instances:
+            yield _builddiv(app_config, time, instance, request, historical)
+        return
+
+    futures = _builddivs_in_threads(instances, time, request, historical, max_workers)
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # the client may have closed the connection, then the remaining divs aren't built
+        for future in futures:
+            future.cancel()
+
+
+def get_instance_in_category(analyses_list, category, name):
+    """Returns the app config and dict of the instance with the name in the category or
+    ``(None, None)`` if there is none."""
+    for app_config, instances_list in get_apps_with_instances_in_category(
+        analyses_list, category
+    ):
+        for instance in instances_list:
+            if instance["name"] == name:
+                return app_config, instance
+    return None, None
+
+
+def _builddivs_in_threads(instances, time, request, historical, max_workers):
+    # builds the divs of the (app_config, instance) tuples in max_workers threads and
+    # returns the futures of the divs in the same order. The threads run in copies of the
+    # context of the request, e.g. to profile the divs.
+    futures = [Future() for _ in instances]
+    work = queue.SimpleQueue()
+    for future, (app_config, instance) in zip(futures, instances):
+        work.put((future, app_config, instance))
+
+    def build():
+        try:
+            while True:
+                try:
+                    future, app_config, instance = work.get_nowait()
+                except queue.Empty:
+                    return
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(
+                        _builddiv(app_config, time, instance, request, historical)
+                    )
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            # each thread opens its own database connections, which have to be closed
+            # again because django only closes the connections of the request thread
+            connections.close_all()
+
+    for _ in range(max_workers):
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(build,), daemon=True
+        ).start()
+    return futures
+
+
+def _builddiv(app_config, time, instance, request, historical):
+    with profiling.phase(f"builddiv.{app_config.name}"):
+        return app_config.builddiv(time, instance, request, historical)
+
+
+def get_statuses_of_instances(app_list, time, time_range, latest_only=False):
     """
     generates a list of nav_elements from a list of analyses
+
+    The statuses of all instances whose analysis doesn't override ``get_instance_status``
+    are loaded with a single query, the others call their own ``get_instance_status``.
+    If only the latest status of the instances at the current time is needed
+    (``latest_only``), it is read from the status snapshots instead of the history.
     """
-    from .models import InstanceStatus
+    from .models import InstanceStatus, InstanceStatusSnapshot
 
-    categories_list = []
+    categories = {}
+
+    bulk_instances = [
+        (
+            instance["name"],
+            instance["category"],
+            app.get_status_time_range(instance, time_range),
+        )
+        for app in app_list
+        if app.has_default_instance_status()
+        for instance in app.instances
+        if not instance.get("is_info", False)
+    ]
+    bulk_statuses = {}
+    if latest_only:
+        bulk_statuses = InstanceStatusSnapshot.objects.get_latest_statuses(
+            time=time, instances=bulk_instances
+        )
+    bulk_statuses.update(
+        InstanceStatus.objects.get_instance_statuses(
+            time=time,
+            instances=[
+                (name, cat, status_time_range)
+                for name, cat, status_time_range in bulk_instances
+                if (name, cat) not in bulk_statuses
+            ],
+        )
+    )
 
     for app in app_list:
         for instance in app.instances:
@@ -194,6 +411,8 @@ def get_statuses_of_instances(app_list, time, time_range):
             order = instance.get("order", -1)
             if instance.get("is_info", False):
                 instance_status = DummyInstanceStatus(time=time, status=STATUS.INFO)
+            elif (name, cat) in bulk_statuses:
+                instance_status = bulk_statuses[(name, cat)]
             else:
                 try:
                     instance_status = app.get_instance_status(
@@ -212,19 +431,17 @@ def get_statuses_of_instances(app_list, time, time_range):
                 status=instance_status,
                 order=order,
             )
-            # check if category of current instance already exists in the categories list
-            if cat not in [n.name for n in categories_list]:
+            # check if category of current instance already exists in the categories dict
+            if cat not in categories:
                 # if not create a new Category object and pass it the current instance
                 # object
-                categories_list.append(CategoryNav(name=cat, instance=instance_object))
+                categories[cat] = CategoryNav(name=cat, instance=instance_object)
             else:
                 # if the category object already exists append the instance object to the
                 # instances list
-                for c in categories_list:
-                    if c.name == cat:
-                        c.instances.append(instance_object)
+                categories[cat].instances.append(instance_object)
     # sort the array
-    categories_list.sort(key=lambda cat: cat.name.lower())
+    categories_list = sorted(categories.values(), key=lambda cat: cat.name.lower())
     for cat in categories_list:
         # order instances as specified in config
         cat.instances.sort(
@@ -1,10 +1,13 @@
 from django.apps import apps
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template import loader
+from django.utils.safestring import mark_safe
 from django.views.defaults import page_not_found
 
+from . import metrics as mt
+from . import profiling
 from . import utilities as ut
 
 
@@ -18,9 +21,10 @@ def home(request):
     # get the instance and category statuses from the different analyses instances and
     # the overall worst status from request_time 24 h into the past
     # used for the status display in the nav bar as well as for the status Overview module
-    statuses = ut.get_statuses_of_instances(
-        analyses, request_time, time_range=settings.OVERVIEW_RANGE
-    )
+    with profiling.phase("statuses"):
+        statuses = ut.get_statuses_of_instances(
+            analyses, request_time, time_range=settings.OVERVIEW_RANGE
+        )
 
     context = {
         "statuses": statuses,
@@ -33,7 +37,8 @@ def home(request):
         "documentation_url": settings.DOCUMENTATION_URL,
     }
 
-    return render(request, "home.html", context=context)
+    with profiling.phase("template"):
+        return render(request, "home.html", context=context)
 
 
 def index(request, category):
@@ -44,12 +49,39 @@ def index(request, category):
     analyses = ut.get_Analyses_from_apps(apps)
 
     # create the objects that will be displayed in the category part of the site
-    statuses = ut.get_statuses_of_instances(
-        analyses, request_time, time_range=settings.PULL_INTERVAL
-    )
+    # the nav bar only shows the latest statuses, which are read from the snapshots if
+    # no past time is requested
+    with profiling.phase("statuses"):
+        statuses = ut.get_statuses_of_instances(
+            analyses,
+            request_time,
+            time_range=settings.PULL_INTERVAL,
+            latest_only=link_date is None,
+        )
 
     # render the instances in the category requested
-    divs = ut.render_instances(analyses, category, request_time, request)
+    # the divs of an explicitly requested time can be cached longer
+    # with lazy panels, only placeholders are sent and the browser loads the divs
+    # with streaming, only the place of the divs is marked, they are built while the rest
+    # of the page is already sent. Profiled pages aren't streamed, because their profile
+    # is finished before the divs would be built.
+    stream = (
+        settings.STREAM_PAGES and not settings.LAZY_PANELS and not profiling.is_active()
+    )
+    with profiling.phase("render_instances"):
+        if settings.LAZY_PANELS:
+            divs = ut.render_placeholders(analyses, category, request)
+        elif stream:
+            instances = ut.get_ordered_instances_in_category(analyses, category)
+            divs = [_DIVS_SENTINEL] if instances else []
+        else:
+            divs = ut.render_instances(
+                analyses,
+                category,
+                request_time,
+                request,
+                historical=link_date is not None,
+            )
 
     # catch case where the category string doesn't match the category of any analysis
     if not divs:
@@ -72,4 +104,67 @@ def index(request, category):
     template = loader.get_template("index.html")
 
     # return the rendered Template as a HTTP response
-    return HttpResponse(template.render(context, request))
+    with profiling.phase("template"):
+        page = template.render(context, request)
+    if stream:
+        if _DIVS_SENTINEL in page:
+            return _stream_page(
+                page, instances, request_time, request, historical=link_date is not None
+            )
+        # e.g. an overridden template which doesn't show the divs, the page is rendered
+        # again with the divs instead of streaming it
+        with profiling.phase("render_instances"):
+            context["divs"] = ut.render_instances(
+                analyses,
+                category,
+                request_time,
+                request,
+                historical=link_date is not None,
+            )
+        with profiling.phase("template"):
+            page = template.render(context, request)
+    return HttpResponse(page)
+
+
+# marks the place of the divs in the category page if it is streamed
+_DIVS_SENTINEL = mark_safe("<!-- happyface divs -->")
+
+
+def _stream_page(page, instances, time, request, historical):
+    # sends the page up to the divs right away and the divs in between as they are built
+    head, tail = page.split(_DIVS_SENTINEL, 1)
+
+    def content():
+        yield head
+        yield from ut.stream_instances(instances, time, request, historical)
+        yield tail
+
+    response = StreamingHttpResponse(content())
+    # nginx would buffer the whole page otherwise
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def panel(request, category, instance):
+    # renders the div of a single instance, which is loaded by the placeholder of the
+    # instance on the category page
+    link_date, request_time, form, reload = ut.extract_time_from_request(request)
+
+    app_config, instance = ut.get_instance_in_category(
+        ut.get_Analyses_from_apps(apps), category, instance
+    )
+    if app_config is None:
+        return page_not_found(request, "This instance is not available.")
+
+    with profiling.phase(f"builddiv.{app_config.name}"):
+        div = app_config.builddiv(
+            request_time, instance, request, historical=link_date is not None
+        )
+    return HttpResponse(div)
+
+
+def metrics(request):
+    # export the metrics of getData and builddiv in the Prometheus text format
+    if not settings.METRICS_ENABLED or not mt.is_authorized(request):
+        return page_not_found(request, "The metrics are disabled.")
+    return HttpResponse(mt.export(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,310 @@
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.utils import timezone
+
+from Happyface4 import helpers, utilities
+from Happyface4.app_configs import AnalysisConfig
+from Happyface4.fetcher import Fetcher
+from Happyface4.models import InstanceStatus
+from Happyface4.status import STATUS
+
+
+class BenchmarkAnalysis(AnalysisConfig):
+    """Analysis with synthetic instances, which fetches a JSON document from the stub
+    server and renders the analysis base template."""
+
+    name = "benchmark"
+    instances = []
+
+    def __init__(self, analysis_id, instance_count, category_count, source):
+        self.instances = [
+            {
+                "name": f"bench_{analysis_id}_{i}",
+                "category": f"Bench {i % category_count}",
+                "source": source,
+                "description": "Synthetic benchmark instance",
+                "template": "analysis_base.html",
+            }
+            for i in range(instance_count)
+        ]
+        super().__init__(f"bench_{analysis_id}", sys.modules[__name__])
+
+    def extract_data_from_url(self, instance):
+        r = helpers.get_session().get(instance["source"], timeout=helpers.get_timeout())
+        return r.json()
+
+    def save_data_to_db(self, data, instance):
+        return (
+            STATUS.CRITICAL if len(data["values"]) > 1000 else STATUS.OK
+        ), timezone.now()
+
+    def retrieve_data_from_db(self, instance, time_of_readout, dt):
+        return {"values": [1, 2, 3]}, time_of_readout
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the hot paths of the website and of getData with synthetic analyses, instances and status history in a temporary test database, which is deleted afterwards. The results can be saved and compared with earlier results."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--analyses",
+            type=int,
+            default=5,
+            help="Number of synthetic analyses (default 5)",
+        )
+        parser.add_argument(
+            "--instances",
+            type=int,
+            default=20,
+            help="Number of instances per analysis (default 20)",
+        )
+        parser.add_argument(
+            "--categories",
+            type=int,
+            default=5,
+            help="Number of categories the instances are distributed over (default 5)",
+        )
+        parser.add_argument(
+            "--history",
+            type=int,
+            default=96,
+            help="Number of statuses per instance, one per pull interval (default 96)",
+        )
+        parser.add_argument(
+            "--payload",
+            type=int,
+            default=10,
+            help="Size of the documents of the stub server in kB (default 10)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=10,
+            help="How often each benchmark is repeated (default 10)",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed of the random statuses (default 0)",
+        )
+        parser.add_argument(
+            "--output",
+            help="Saves the results as JSON file",
+        )
+        parser.add_argument(
+            "--compare",
+            help="JSON file with earlier results to compare the results with",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=20,
+            help="Slowdown in percent of the median compared to the earlier results, which counts as regression (default 20)",
+        )
+
+    def handle(self, *args, **options):
+        server = self.start_server(options["payload"])
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            source = f"http://127.0.0.1:{server.server_address[1]}/data"
+            self.analyses = [
+                BenchmarkAnalysis(
+                    i, options["instances"], options["categories"], source
+                )
+                for i in range(options["analyses"])
+            ]
+            self.fill_history(options["history"], options["seed"])
+            # the views get the synthetic analyses instead of the installed ones
+            with mock.patch.object(
+                utilities, "get_Analyses_from_apps", return_value=self.analyses
+            ), override_settings(ALLOWED_HOSTS=["*"]):
+                results = {
+                    name: self.measure(function, options["repeat"])
+                    for name, function in self.benchmarks()
+                }
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            server.shutdown()
+
+        results = {
+            "parameters": {
+                key: options[key]
+                for key in (
+                    "analyses",
+                    "instances",
+                    "categories",
+                    "history",
+                    "payload",
+                    "repeat",
+                    "seed",
+                )
+            },
+            "database": connection.vendor,
+            "time": timezone.now().isoformat(),
+            "results": results,
+        }
+        self.print_results(results)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+        if options["compare"]:
+            with open(options["compare"]) as old_results:
+                self.compare(json.load(old_results), results, options["threshold"])
+
+    def start_server(self, payload_kb):
+        # local HTTP server which answers every request with the same JSON document
+        body = json.dumps({"values": list(range(payload_kb * 1000 // 7))}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def fill_history(self, history, seed):
+        """Adds a status every pull interval into the past for each instance."""
+        rng = random.Random(seed)
+        self.now = timezone.now().replace(second=0, microsecond=0)
+        for analysis in self.analyses:
+            for instance in analysis.instances:
+                InstanceStatus.objects.bulk_update_or_create(
+                    [
+                        (
+                            self.now - settings.PULL_INTERVAL * step,
+                            instance["name"],
+                            instance["category"],
+                            rng.choice([STATUS.OK, STATUS.OK, STATUS.WARNING, 2]),
+                        )
+                        for step in range(history)
+                    ]
+                )
+
+    def benchmarks(self):
+        """Returns the names and functions of the benchmarks."""
+        category = self.analyses[0].instances[0]["category"]
+        client = Client()
+        overview_statuses = utilities.get_statuses_of_instances(
+            self.analyses, self.now, time_range=settings.OVERVIEW_RANGE
+        )
+
+        def render_instances(cold):
+            if cold:
+                caches["divs"].clear()
+            utilities.render_instances(self.analyses, category, self.now, None)
+
+        def statuses_list():
+            # the merged statuses are cached by the CategoryNav, so new ones are used
+            for category_nav in overview_statuses:
+                category_nav._statuses_list = None
+                category_nav.statuses_list()
+
+        def request(url):
+            response = client.get(url)
+            if response.status_code != 200:
+                raise CommandError(f"{url} returned {response.status_code}")
+
+        return [
+            (
+                "statuses_overview",
+                lambda: utilities.get_statuses_of_instances(
+                    self.analyses, self.now, time_range=settings.OVERVIEW_RANGE
+                ),
+            ),
+            (
+                "statuses_latest",
+                lambda: utilities.get_statuses_of_instances(
+                    self.analyses,
+                    self.now,
+                    time_range=settings.PULL_INTERVAL,
+                    latest_only=True,
+                ),
+            ),
+            ("statuses_list", statuses_list),
+            ("render_instances_cold", lambda: render_instances(cold=True)),
+            ("render_instances_cached", lambda: render_instances(cold=False)),
+            ("request_home", lambda: request("/")),
+            ("request_index", lambda: request(f"/categories/{category}/")),
+            (
+                "getData_cycle",
+                lambda: Fetcher().run(
+                    [
+                        (analysis, instance)
+                        for analysis in self.analyses
+                        for instance in analysis.instances
+                    ]
+                ),
+            ),
+        ]
+
+    def measure(self, function, repeat):
+        """Returns the median, 95th percentile and minimum latency in ms of the
+        function, after one run to warm up."""
+        function()
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            durations.append((time.perf_counter() - start) * 1000)
+        durations.sort()
+        return {
+            "median_ms": statistics.median(durations),
+            "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            "min_ms": durations[0],
+        }
+
+    def print_results(self, results):
+        self.stdout.write(f"{'benchmark':<25} {'median':>10} {'p95':>10} {'min':>10}")
+        for name, result in results["results"].items():
+            self.stdout.write(
+                f"{name:<25} {result['median_ms']:>8.2f}ms {result['p95_ms']:>8.2f}ms {result['min_ms']:>8.2f}ms"
+            )
+
+    def compare(self, old, new, threshold):
+        """Prints the change of the medians and fails if a benchmark got slower than
+        the threshold."""
+        if old["parameters"] != new["parameters"]:
+            self.stderr.write(
+                "The results were measured with other parameters, they may not be comparable."
+            )
+        self.stdout.write(f"\n{'benchmark':<25} {'old':>10} {'new':>10} {'change':>8}")
+        regressions = []
+        for name, result in new["results"].items():
+            if name not in old["results"]:
+                continue
+            old_median = old["results"][name]["median_ms"]
+            change = (result["median_ms"] - old_median) / old_median * 100
+            self.stdout.write(
+                f"{name:<25} {old_median:>8.2f}ms {result['median_ms']:>8.2f}ms {change:>+7.1f}%"
+            )
+            if change > threshold:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(
+                f"The benchmarks {', '.join(regressions)} are more than {threshold}% slower."
+            )
@@ -0,0 +1,147 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.utils import timezone
+
+from Happyface4.models import Category, Instance, InstanceStatus
+
+
+class Command(BaseCommand):
+    help = "Measures the latency of the instance status queries with and without the (instance, category, time) index. The rows are written to a temporary test database, which is deleted afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            nargs="+",
+            type=int,
+            default=[1_000_000, 10_000_000],
+            help="Numbers of instance status rows to benchmark (default 1000000 10000000)",
+        )
+        parser.add_argument(
+            "--instances",
+            type=int,
+            default=150,
+            help="Number of instances the rows are distributed over (default 150)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="How often each query is repeated (default 20)",
+        )
+
+    def handle(self, *args, **options):
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            self.stdout.write(
+                f"{'rows':>10} {'query':<10} {'with index':>12} {'without':>12}"
+            )
+            filled_rows = 0
+            for rows in sorted(options["rows"]):
+                instances = self.fill_db(
+                    rows, filled_rows, options["instances"], options["repeat"]
+                )
+                filled_rows = rows
+                with_index = self.measure(instances, options["repeat"])
+                self.drop_index()
+                without_index = self.measure(instances, options["repeat"])
+                self.restore_index()
+                for query in with_index:
+                    self.stdout.write(
+                        f"{rows:>10} {query:<10} {with_index[query]:>10.2f}ms {without_index[query]:>10.2f}ms"
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+    def fill_db(self, rows, filled_rows, instance_count, repeat):
+        """Adds rows to the instance statuses until there are ``rows`` rows. Each instance
+        gets a status every 5 minutes into the past."""
+        instances = [
+            (
+                Instance.objects.get_or_create(name=f"benchmark_instance_{i}")[0],
+                Category.objects.get_or_create(name=f"benchmark_category_{i % 10}")[0],
+            )
+            for i in range(instance_count)
+        ]
+        self.now = timezone.now().replace(second=0, microsecond=0)
+        batch = []
+        for row in range(filled_rows, rows):
+            instance, category = instances[row % instance_count]
+            batch.append(
+                InstanceStatus(
+                    time=self.now - timedelta(minutes=5 * (row // instance_count)),
+                    instance=instance,
+                    category=category,
+                    status=row % 5 - 2,
+                )
+            )
+            if len(batch) == 10000:
+                InstanceStatus.objects.bulk_create(batch)
+                batch = []
+        InstanceStatus.objects.bulk_create(batch)
+        self.analyze()
+        return [(i.name, c.name) for i, c in instances[:repeat]]
+
+    def measure(self, instances, repeat):
+        """Returns the median latency in ms of the status queries used by the website."""
+        queries = {
+            "latest": lambda name, category: list(
+                InstanceStatus.objects.get_instance_status(
+                    self.now, name, category, settings.PULL_INTERVAL
+                )
+            ),
+            "overview": lambda name, category: list(
+                InstanceStatus.objects.get_instance_status(
+                    self.now, name, category, settings.OVERVIEW_RANGE
+                )
+            ),
+            "bulk": lambda name, category: InstanceStatus.objects.get_instance_statuses(
+                self.now,
+                [
+                    (name, category, settings.OVERVIEW_RANGE)
+                    for name, category in instances
+                ],
+            ),
+        }
+        latencies = {}
+        for query, function in queries.items():
+            durations = []
+            for i in range(repeat):
+                name, category = instances[i % len(instances)]
+                start = time.perf_counter()
+                function(name, category)
+                durations.append((time.perf_counter() - start) * 1000)
+            latencies[query] = statistics.median(durations)
+        return latencies
+
+    def drop_index(self):
+        # restore the schema before the unique constraint, which had an index on the
+        # instance foreign key
+        with connection.schema_editor() as editor:
+            editor.remove_constraint(
+                InstanceStatus, InstanceStatus._meta.constraints[0]
+            )
+            editor.add_index(InstanceStatus, self.old_index())
+        self.analyze()
+
+    def restore_index(self):
+        with connection.schema_editor() as editor:
+            editor.remove_index(InstanceStatus, self.old_index())
+            editor.add_constraint(InstanceStatus, InstanceStatus._meta.constraints[0])
+        self.analyze()
+
+    def old_index(self):
+        return models.Index(fields=["instance"], name="benchmark_instance_id")
+
+    def analyze(self):
+        # update the statistics of the query planner
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"ANALYZE {connection.ops.quote_name(InstanceStatus._meta.db_table)}"
+            )
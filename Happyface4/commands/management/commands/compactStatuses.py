@@ -0,0 +1,37 @@
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Happyface4 import utilities
+from Happyface4.models import InstanceStatus, InstanceStatusRollup
+
+logger = logging.getLogger("getData")
+
+
+class Command(BaseCommand):
+    help = "Rolls the instance statuses older than settings.STATUS_RETENTION up into hourly worst statuses and the hourly statuses older than settings.STATUS_HOURLY_RETENTION into daily ones. If settings.DATA_RETENTION is set, the older data of the analyses is deleted."
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        rolled_up = InstanceStatusRollup.objects.roll_up(
+            InstanceStatus.objects.all(),
+            InstanceStatusRollup.HOUR,
+            before=now - settings.STATUS_RETENTION,
+        )
+        logger.info(f"Rolled up {rolled_up} instance statuses into hourly statuses.")
+        rolled_up = InstanceStatusRollup.objects.roll_up(
+            InstanceStatusRollup.objects.filter(resolution=InstanceStatusRollup.HOUR),
+            InstanceStatusRollup.DAY,
+            before=now - settings.STATUS_HOURLY_RETENTION,
+        )
+        logger.info(f"Rolled up {rolled_up} hourly statuses into daily statuses.")
+
+        if settings.DATA_RETENTION:
+            for analysis in utilities.get_Analyses_from_apps(apps):
+                analysis.delete_data_before(now - settings.DATA_RETENTION)
+                logger.info(
+                    f"Deleted data of module {analysis.name} before {now - settings.DATA_RETENTION}."
+                )
@@ -1,3 +1,4 @@
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 import os
@@ -5,14 +6,20 @@ import logging
 from django.core.management import call_command
 import signal
 import time
+from datetime import date
 from threading import Event
 import requests
+from django.db import connections
+
+from Happyface4 import utilities
+from Happyface4.fetcher import Fetcher
+from Happyface4.scheduler import FetchJob, Job, Scheduler
 
 logger = logging.getLogger("getData")
 
 
 class Command(BaseCommand):
-    help = "Command that goes through the different installed Analyses and calls their respective getData functions. This is repeated every timestep (set in the settings.py).\nIf this task shall run in the background you can use >>nohup ./manage.py getDataRoutine &<<."
+    help = "Command that goes through the different installed Analyses and calls their respective getData functions. This is repeated every timestep (set in the settings.py) by a long running worker.\nIf this task shall run in the background you can use >>nohup ./manage.py getDataRoutine &<<."
 
     def __init__(self, *args, **kwargs):
         self.exit = Event()
@@ -24,20 +31,48 @@ class Command(BaseCommand):
         self.exit.set()
 
     def handle(self, *args, **options):
-        sleep_sec = getattr(
-            settings, "GETDATA_SLEEP", 60
-        )  # time between checks if it's time to fetch data in seconds.
-        while not self.exit.is_set():
-            if time.time() % settings.PULL_INTERVAL.seconds <= sleep_sec:
-                # send healthcheck signal start
-                self.ping_healthcheck("/start")
-                # execute getData
-                call_command("getData")
-                # send healthcheck signal
-                self.ping_healthcheck()
-            self.exit.wait(sleep_sec)
+        # the analyses and the fetcher with its threads and their HTTP and database
+        # connections are kept, each instance is fetched at its own slot in the pull
+        # interval (see Happyface4.scheduler)
+        now = time.time()
+        scheduler = Scheduler()
+        for analysis in utilities.get_Analyses_from_apps(apps):
+            for instance in analysis.instances:
+                scheduler.add(FetchJob(analysis, instance), now)
+        with Fetcher() as fetcher:
+            self.fetcher = fetcher
+            self.last_compaction = None
+            scheduler.add(
+                Job(
+                    "housekeeping",
+                    settings.PULL_INTERVAL.total_seconds(),
+                    function=self.housekeeping,
+                ),
+                now,
+            )
+            fetcher.serve(scheduler, self.exit)
         self.exit.clear()
 
+    def housekeeping(self):
+        """Runs once per pull interval."""
+        try:
+            # send healthcheck signal, if instances were fetched since the last one
+            if (
+                self.fetcher.last_cycle
+                and time.time() - self.fetcher.last_cycle["finished"]
+                < settings.PULL_INTERVAL.total_seconds()
+            ):
+                self.ping_healthcheck()
+            # roll up the old instance statuses once a day
+            if (
+                getattr(settings, "COMPACT_STATUSES", False)
+                and self.last_compaction != date.today()
+            ):
+                call_command("compactStatuses")
+                self.last_compaction = date.today()
+        finally:
+            connections.close_all()
+
     def ping_healthcheck(self, url_appendix=""):
         """Send a signal to healthcheck.io to monitor happyface automatically
 
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from Happyface4.models import Metric
+
+
+class Command(BaseCommand):
+    help = "Prints the instances with the longest mean duration of a phase (getData, extract, save, status_write or builddiv), measured by all processes since the metrics were reset."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--phase",
+            default="getData",
+            help="The measured phase (default getData)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=10,
+            help="Number of instances to print (default 10)",
+        )
+        parser.add_argument(
+            "--sort",
+            choices=["mean", "max", "total"],
+            default="mean",
+            help="Sort by the mean, longest or total duration (default mean)",
+        )
+
+    def handle(self, *args, **options):
+        rows = [
+            dict(row, seconds_mean=row["seconds_total"] / row["count"])
+            for row in Metric.objects.totals().filter(phase=options["phase"])
+            if row["count"]
+        ]
+        sort_key = {
+            "mean": "seconds_mean",
+            "max": "seconds_max",
+            "total": "seconds_total",
+        }[options["sort"]]
+        rows.sort(key=lambda row: row[sort_key], reverse=True)
+        self.stdout.write(
+            f"{'analysis':<20} {'instance':<30} {'runs':>6} {'errors':>6} {'mean':>9} {'max':>9} {'kB/run':>9} {'queries/run':>11}"
+        )
+        for row in rows[: options["limit"]]:
+            self.stdout.write(
+                f"{row['analysis']:<20} {row['instance']:<30} {row['count']:>6} {row['errors']:>6} {row['seconds_mean']:>8.2f}s {row['seconds_max']:>8.2f}s {row['payload_bytes'] / row['count'] / 1000:>9.1f} {row['queries'] / row['count']:>11.1f}"
+            )